@@ -1,14 +1,20 @@
 # %%
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import eqnet
 from eqnet.utils import detect_peaks, extract_picks
 from dataclasses import dataclass
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Union
 import torch
 import torch.nn.functional as F
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class Config:
@@ -19,7 +25,11 @@ class Config:
     min_prob = 0.5
     amp = True
     dtype = torch.float32
+    amp_dtype = torch.float16
     location = None
+    compile = True
+    max_batch_size = 8
+    max_delay_ms = 20
 
 
 def padding(data, min_nt=1024, min_nx=1024):
@@ -68,36 +78,145 @@ def load_model(args):
     return model
 
 
+def warmup(model, args, nt=1024, nx=1024, steps=3):
+    ## run a few dummy requests for every batch size the Batcher can form, so that compilation and CUDA graph
+    ## recording are not paid by real requests
+    with torch.inference_mode(), torch.amp.autocast(args.device, dtype=args.amp_dtype, enabled=args.amp):
+        for batch_size in range(1, args.max_batch_size + 1):
+            data = torch.zeros([batch_size, 1, nt, nx], dtype=args.dtype)
+            for _ in range(steps):
+                model({"data": data.to(args.device, memory_format=torch.channels_last)})
+
+
 ###################### FastAPI ######################
 app = FastAPI()
 args = Config()
 model = load_model(args)
 model.to(args.device)
+model = model.to(memory_format=torch.channels_last)
 model.eval()
+## the CUDA graphs recorded by mode="reduce-overhead" are thread-local, so warmup and every request run on one thread
+inference_pool = ThreadPoolExecutor(max_workers=1)
+if args.compile:
+    ## inputs are padded to multiples of 1024 (see padding), so only a few shapes are compiled
+    model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+    inference_pool.submit(warmup, model, args).result()
 
 
-@app.post("/predict")
-def predict(meta: Data):
-    with torch.inference_mode():
-        with torch.cuda.amp.autocast(enabled=args.amp):
-            print(meta["nt"], meta["nx"])
-            output = model(meta)["phase"][:, :, : meta["nt"], : meta["nx"]]
-            scores = torch.softmax(output, dim=1)  # [batch, nch, nt, nsta]
-            topk_scores, topk_inds = detect_peaks(scores, vmin=args.min_prob, kernel=21)
-
-            picks = extract_picks(
-                topk_inds,
-                topk_scores,
-                file_name=meta["id"],
-                begin_time=meta["timestamp"] if "timestamp" in meta else None,
-                dt=meta["dt_s"] if "dt_s" in meta else 0.01,
-                vmin=args.min_prob,
-                phases=args.phases,
-            )
+def predict(meta):
+    with torch.inference_mode(), torch.amp.autocast(args.device, dtype=args.amp_dtype, enabled=args.amp):
+        meta["data"] = meta["data"].to(args.device, memory_format=torch.channels_last, non_blocking=True)
+        output = model(meta)["phase"][:, :, : meta["nt"], : meta["nx"]]
+        scores = torch.softmax(output, dim=1)  # [batch, nch, nt, nsta]
+        topk_scores, topk_inds = detect_peaks(scores, vmin=args.min_prob, kernel=21)
+
+        picks = extract_picks(
+            topk_inds,
+            topk_scores,
+            file_name=meta["id"],
+            begin_time=meta["timestamp"] if "timestamp" in meta else None,
+            dt=meta["dt_s"] if "dt_s" in meta else 0.01,
+            vmin=args.min_prob,
+            phases=args.phases,
+        )
 
     return {"picks": picks}
 
 
+def to_meta(data: Data):
+    vec = torch.tensor(data.vec, dtype=args.dtype)
+    vec = vec.reshape(1, 1, *vec.shape[-2:])  # [batch, nch, nt, nsta]
+    nt, nx = vec.shape[-2:]
+    return {"id": data.id, "timestamp": data.timestamp, "data": padding(vec), "dt_s": data.dt_s, "nt": nt, "nx": nx}
+
+
+class Batcher:
+    """Coalesce concurrent requests of the same shape into one model batch."""
+
+    def __init__(self, max_batch_size=8, max_delay_ms=20):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        self.queue = asyncio.Queue()
+
+    async def submit(self, meta):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((meta, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for meta, future in requests:
+                key = (tuple(meta["data"].shape[1:]), meta["nt"], meta["nx"], meta["dt_s"])
+                groups.setdefault(key, []).append((meta, future))
+            for group in groups.values():
+                await self.run_batch(group)
+
+    async def run_batch(self, group):
+        try:
+            metas = [meta for meta, _ in group]
+            meta = {
+                "id": sum([x["id"] for x in metas], []),
+                "timestamp": sum([x["timestamp"] for x in metas], []),
+                "data": torch.cat([x["data"] for x in metas], dim=0),
+                "dt_s": metas[0]["dt_s"],
+                "nt": metas[0]["nt"],
+                "nx": metas[0]["nx"],
+            }
+            picks = (await asyncio.get_running_loop().run_in_executor(inference_pool, predict, meta))["picks"]
+        except Exception as e:
+            for _, future in group:
+                ## the future is already cancelled if its client disconnected
+                if not future.done():
+                    future.set_exception(e)
+            return
+        i = 0
+        for x, future in group:
+            n = len(x["data"])
+            if not future.done():
+                future.set_result({"picks": picks[i : i + n]})
+            i += n
+
+
+batcher = Batcher(max_batch_size=args.max_batch_size, max_delay_ms=args.max_delay_ms)
+
+
+def restart_batcher(task):
+    if task.cancelled():
+        return
+    logger.error("Batcher stopped, restarting", exc_info=task.exception())
+    start_batcher_task()
+
+
+def start_batcher_task():
+    ## keep a reference so the task is not garbage-collected, and restart it if it ever fails
+    app.state.batcher_task = asyncio.create_task(batcher.run())
+    app.state.batcher_task.add_done_callback(restart_batcher)
+
+
+@app.on_event("startup")
+async def start_batcher():
+    start_batcher_task()
+
+
+@app.post("/predict", response_class=ORJSONResponse)
+async def predict_api(data: Data):
+    ## return the response directly to skip jsonable_encoder; orjson serializes the picks in C
+    return ORJSONResponse(await batcher.submit(to_meta(data)))
+
+
 @app.get("/healthz")
 def healthz():
     return {"status": "ok"}
@@ -113,17 +232,19 @@ if __name__ == "__main__":
     h5_file = "ci37238204.h5"
 
     with h5py.File(h5_file, "r") as f:
-        vec = f["data"][:].T
-        vec = vec[np.newaxis, :, :]
+        vec = np.empty(f["data"].shape, dtype=np.float32)
+        f["data"].read_direct(vec)
         timestamp = f["data"].attrs["begin_time"]
         data_id = f'{f["data"].attrs["event_id"]}'
 
     # %%
-    data = torch.tensor(vec, dtype=args.dtype).unsqueeze(0)  # [batch, nch, nt, nsta]
+    data = torch.from_numpy(vec).T[None, None, :, :]  # [batch, nch, nt, nsta]
     nt, nx = data.shape[-2:]
     data = padding(data)
+    if torch.cuda.is_available():
+        data = data.pin_memory()
     meta = {"id": [data_id], "timestamp": [timestamp], "data": data, "dt_s": 0.01, "nx": nx, "nt": nt}
-    picks = predict(meta)["picks"]
+    picks = inference_pool.submit(predict, meta).result()["picks"]
     data = data[:, :, :nt, :nx]
 
     # %%
@@ -41,11 +41,16 @@ def calc_snr(waveform, picks, noise_window=300, signal_window=300, gap_window=50
 h5_in = "ncedc.h5"
 h5_out = "ncedc_event_dataset_polarity_2.h5"
 event_csv = pd.read_hdf(h5_in, "events")
-event_csv["time_id"] = event_csv["time"].apply(
-    lambda x: x[0:4] + x[5:7] + x[8:10] + x[11:13] + x[14:16] + x[17:19] + x[20:22]
-)
+## YYYY-MM-DDTHH:MM:SS.ffffff -> YYYYMMDDHHMMSSff
+event_csv["time_id"] = event_csv["time"].str.replace(r"\D", "", regex=True).str.slice(0, 16)
+if len(event_csv) > 0:
+    x = event_csv["time"].iloc[0]
+    assert event_csv["time_id"].iloc[0] == x[0:4] + x[5:7] + x[8:10] + x[11:13] + x[14:16] + x[17:19] + x[20:22]
 phase_csv = pd.read_hdf(h5_in, "catalog")
 phase_csv.set_index("event_index", inplace=True)
+## group phases by event once instead of repeated .loc lookups in the event loop
+phase_groups = {k: v for k, v in phase_csv.groupby(level=0)}
+first_p_times = phase_csv.groupby(level=0)["p_time"].min().to_dict()
 with open("event_id.json", "r") as f:
     time_to_event_id = json.load(f)
 
@@ -59,169 +64,252 @@ post_window = 9000
 sampling_rate = 100
 # plt.figure()
 
-with h5py.File(h5_in, "r") as fp_in:
+## per-event station metadata table, stored as one compound dataset per event instead of ~20 attributes per station;
+## a dataset rather than an attribute, since attributes are capped by the 64 KB object header (~300 stations)
+station_dtype = np.dtype(
+    [
+        ("station_id", "S32"),
+        ("network", "S8"),
+        ("station", "S8"),
+        ("location", "S8"),
+        ("distance_km", "f4"),
+        ("azimuth", "f4"),
+        ("emergence_angle", "f4"),
+        ("latitude", "f8"),
+        ("longitude", "f8"),
+        ("elevation_m", "f4"),
+        ("p_index", "i4"),
+        ("s_index", "i4"),
+        ("component", "S3"),
+        ("dt_s", "f4"),
+        ("unit", "S16"),
+        ("snr", "f4", (3,)),
+        ("phase_time", "S23", (2,)),
+        ("phase_score", "f4", (2,)),
+        ("phase_remark", "S4", (2,)),
+        ("phase_polarity", "S1", (2,)),
+    ]
+)
+
+
+## the chunk cache is allocated per open dataset in every worker, so split one budget across the pool
+chunk_cache_bytes = 1024 * 1024 * 1024
+
+
+def init_worker():
+    ## HDF5 handles are not fork-safe; open one read-only handle per worker
+    global fp_in, waveform
+    fp_in = h5py.File(h5_in, "r", rdcc_nbytes=max(1024 * 1024, chunk_cache_bytes // mp.cpu_count()))
+    waveform = np.zeros([pre_window + post_window, 3], dtype=np.float32)
+
+
+def process_event(event):
+    phases = phase_groups[event["index"]]
+    first_p_arrival = datetime.fromisoformat(first_p_times[event["index"]])
+    anchor_time = first_p_arrival  ## put anchor at 30s of the window
+    # anchor_time = event_time
+    anchor_time_np = np.datetime64(anchor_time, "us")
+
+    # event_id = event["index"]
+    event_id = "nc" + time_to_event_id[event["time_id"]]
+    event_time = datetime.strptime(event["time"], "%Y-%m-%dT%H:%M:%S.%f")
+    event_time_index = int((event_time - anchor_time).total_seconds() * sampling_rate) + pre_window
+    event_latitude = event["latitude"]
+    event_longitude = event["longitude"]
+    event_depth_km = event["depth_km"]
+
+    event_attrs = {}
+    event_attrs["event_id"] = event_id
+    event_attrs["event_time"] = event_time.isoformat(timespec="milliseconds")
+    event_attrs["event_time_index"] = event_time_index
+    event_attrs["begin_time"] = (anchor_time - timedelta(seconds=pre_window / sampling_rate, )).isoformat(
+        timespec="milliseconds"
+    )
+    event_attrs["end_time"] = (anchor_time + timedelta(seconds=post_window / sampling_rate)).isoformat(
+        timespec="milliseconds"
+    )
+    # event_attrs["time_reference"] = anchor_time.isoformat(timespec="milliseconds")
+    # event_attrs["time_before"] = pre_window/sampling_rate
+    # event_attrs["time_after"] = post_window/sampling_rate
+    event_attrs["latitude"] = event_latitude
+    event_attrs["longitude"] = event_longitude
+    event_attrs["depth_km"] = event_depth_km
+    event_attrs["magnitude"] = event["magnitude"]
+    event_attrs["magnitude_type"] = event["magnitude_type"]
+    event_attrs["num_stations"] = len(phases)
+
+    ##
+    has_polarity = False
+    if event_id in polarity.index:
+        has_polarity = True
+        event_attrs["strike"] = list(set(polarity.loc[event_id]["strike"].values))[0]
+        event_attrs["dip"] = list(set(polarity.loc[event_id]["dip"].values))[0]
+        event_attrs["rake"] = list(set(polarity.loc[event_id]["rake"].values))[0]
+
+    stations = []
+    for j, phase in enumerate(phases.itertuples(index=False)):
+
+        trace = fp_in[f"data/{phase.fname}"]
+
+        ## P and S arrivals as datetime64[us]; astype(int) truncates like int(total_seconds * sampling_rate)
+        phase_time_np = np.array([trace.attrs["p_time"], trace.attrs["s_time"]], dtype="datetime64[us]")
+        phase_index_np = ((phase_time_np - anchor_time_np).astype(np.int64) / 1e6 * sampling_rate).astype(int)
+        p_arrival_index, s_arrival_index = (phase_index_np + pre_window).tolist()
+
+        begin_index = trace.attrs["p_idx"] - p_arrival_index
+        end_index = begin_index + pre_window + post_window
+        if begin_index < 0:
+            print(trace.attrs["p_idx"], p_arrival_index, begin_index, end_index)
+        # if trace[begin_index:end_index,:].shape != (9000, 3):
+        #     print(trace.shape, p_arrival_index, begin_index, end_index)
+
+        ## read the window once directly into the preallocated buffer
+        waveform.fill(0)
+        src_lo = max(0, begin_index)
+        src_hi = min(max(0, end_index), trace.shape[0])
+        if src_hi > src_lo:
+            trace.read_direct(waveform, np.s_[src_lo:src_hi, :], np.s_[0 : src_hi - src_lo, :])
+        waveform *= 1e6
+
+        ## P arrivals are at sample 6000 of the trace, at least pre_window samples into the window just read
+        SNR = calc_snr(waveform.T, [6000 - src_lo])
+        SNR = np.array(SNR)
+        # if not ((len(SNR) >= 3) and (np.all(SNR) > 0) and (np.max(SNR) > 2.0)):
+        # if not (np.all(SNR) > 0):
+        #     continue
+
+        network = trace.attrs["network"]
+        station = trace.attrs["station"]
+        location = trace.attrs["location_code"] if trace.attrs["location_code"] != "--" else ""
+        channels = trace.attrs["channels"].split(",")
+
+        distance_km = trace.attrs["distance_km"]
+        azimuth = trace.attrs["azimuth"]
+        p_polarity = trace.attrs["first_motion"]
+        if p_polarity not in ["U", "D"]:
+            p_polarity = "N"
+        s_polarity = "N"
+        if has_polarity:
+            station_id = f"{network}.{station}.{location}.{channels[0][:-1]}"
+            station_ids = polarity.loc[event_id]["station_id"].values
+            if station_id in station_ids:
+                radiation = polarity.loc[event_id].loc[station_ids == station_id]
+                p_radiation = radiation[radiation["phase_type"] == "P"]["radiation"].values[0]
+                s_radiation = radiation[radiation["phase_type"] == "S"]["radiation"].values[0]
+                p_radiation = round(p_radiation, 3)
+                s_radiation = round(s_radiation, 3)
+                if ((np.sign(p_radiation) > 0) and (p_polarity == "D")) or ((np.sign(p_radiation) < 0) and (p_polarity == "U")):
+                    print("P polarity is wrong", p_radiation, p_polarity, event_id, station_id)
+                    p_polarity = "N"
+                    s_polarity = "N"
+                else:
+                    if np.sign(p_radiation) > 0:
+                        p_polarity = "U"
+                    elif np.sign(p_radiation) < 0:
+                        p_polarity = "D"
+                    else:
+                        print("P radiation is 0", p_radiation, p_polarity, event_id, station_id)
+                    if np.sign(s_radiation) > 0:
+                        s_polarity = "U"
+                    elif np.sign(s_radiation) < 0:
+                        s_polarity = "D"
+                    else:
+                        print("S radiation is 0", s_radiation, s_polarity, event_id, station_id)
+            
+        emergence_angle = trace.attrs["emergence_angle"]
+        station_latitude = trace.attrs["station_latitude"]
+        station_longitude = trace.attrs["station_longitude"]
+        station_elevation_m = trace.attrs["station_elevation_m"]
+        dt_s = trace.attrs["dt"]
+        unit = trace.attrs["unit"]
+        phase_type = ["P", "S"]
+        phase_index = [p_arrival_index, s_arrival_index]
+        phase_time = np.datetime_as_string(phase_time_np, unit="ms").tolist()
+        phase_score = [phase.p_weight, phase.s_weight]
+        phase_remark = [phase.p_remark, phase.s_remark]
+        phase_polarity = [p_polarity, s_polarity]
+        event_ids = [event_id, event_id]
+        assert dt_s == 1.0 / sampling_rate
+
+        station_id = f"{network}.{station}.{location}.{channels[0][:-1]}"
+        attrs = {}
+        attrs["network"] = network
+        attrs["station"] = station
+        attrs["location"] = location
+        attrs["component"] = [x[-1] for x in channels]
+        attrs["distance_km"] = distance_km
+        attrs["azimuth"] = azimuth
+        attrs["emergence_angle"] = emergence_angle
+        attrs["latitude"] = station_latitude
+        attrs["longitude"] = station_longitude
+        attrs["elevation_m"] = station_elevation_m
+        attrs["dt_s"] = dt_s
+        attrs["unit"] = "1e-6" + unit
+        attrs["snr"] = SNR
+        attrs["phase_type"] = phase_type
+        attrs["phase_index"] = phase_index
+        attrs["phase_time"] = phase_time
+        attrs["phase_score"] = phase_score
+        attrs["phase_remark"] = phase_remark
+        attrs["phase_polarity"] = phase_polarity
+        attrs["event_id"] = event_ids
+        stations.append((station_id, waveform.copy(), attrs))
+
+    return event_id, event_attrs, stations
+
+
+# %%
+if __name__ == "__main__":
+    ncpu = mp.cpu_count()
+    print(f"ncpu = {ncpu}")
+
     # with h5py.File(output_path.joinpath(f"{event['index']:06}.h5"), "w") as fp_out:
     with h5py.File(h5_out, "w") as fp_out:
+        with mp.Pool(ncpu, initializer=init_worker) as pool:
+            for event_id, event_attrs, stations in tqdm(
+                pool.imap_unordered(process_event, event_csv.to_dict("records"), chunksize=16),
+                total=len(event_csv),
+            ):
+                if f"{event_id}" in fp_out:
+                    print(f"{event_id} already exists!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+                    continue
 
-        for i, (_, event) in tqdm(enumerate(event_csv.iterrows()), total=len(event_csv)):
-
-            first_p_arrival = datetime.fromisoformat(phase_csv.loc[[event["index"]]]["p_time"].min())
-            anchor_time = first_p_arrival  ## put anchor at 30s of the window
-            # anchor_time = event_time
-
-            # event_id = event["index"]
-            event_id = "nc" + time_to_event_id[event["time_id"]]
-            event_time = datetime.strptime(event["time"], "%Y-%m-%dT%H:%M:%S.%f")
-            event_time_index = int((event_time - anchor_time).total_seconds() * sampling_rate) + pre_window
-            event_latitude = event["latitude"]
-            event_longitude = event["longitude"]
-            event_depth_km = event["depth_km"]
-
-            if f"{event_id}" in fp_out:
-                print(f"{event_id} already exists!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-                continue
-
-            group = fp_out.create_group(f"{event_id}")
-            group.attrs["event_id"] = event_id
-            group.attrs["event_time"] = event_time.isoformat(timespec="milliseconds")
-            group.attrs["event_time_index"] = event_time_index
-            group.attrs["begin_time"] = (anchor_time - timedelta(seconds=pre_window / sampling_rate, )).isoformat(
-                timespec="milliseconds"
-            )
-            group.attrs["end_time"] = (anchor_time + timedelta(seconds=post_window / sampling_rate)).isoformat(
-                timespec="milliseconds"
-            )
-            # group.attrs["time_reference"] = anchor_time.isoformat(timespec="milliseconds")
-            # group.attrs["time_before"] = pre_window/sampling_rate
-            # group.attrs["time_after"] = post_window/sampling_rate
-            group.attrs["latitude"] = event_latitude
-            group.attrs["longitude"] = event_longitude
-            group.attrs["depth_km"] = event_depth_km
-            group.attrs["magnitude"] = event["magnitude"]
-            group.attrs["magnitude_type"] = event["magnitude_type"]
-            group.attrs["num_stations"] = len(phase_csv.loc[[event["index"]]])
-
-            ##
-            has_polarity = False
-            if event_id in polarity.index:
-                has_polarity = True
-                group.attrs["strike"] = list(set(polarity.loc[event_id]["strike"].values))[0]
-                group.attrs["dip"] = list(set(polarity.loc[event_id]["dip"].values))[0]
-                group.attrs["rake"] = list(set(polarity.loc[event_id]["rake"].values))[0]
-
-            for j, (_, phase) in enumerate(phase_csv.loc[[event["index"]]].iterrows()):
-
-                trace = fp_in[f"data/{phase['fname']}"]
-
-                SNR = calc_snr(trace[:].T, [6000])  ## P arrivals are at 6000
-                SNR = np.array(SNR)
-                # if not ((len(SNR) >= 3) and (np.all(SNR) > 0) and (np.max(SNR) > 2.0)):
-                # if not (np.all(SNR) > 0):
-                #     continue
-
-                p_time = datetime.fromisoformat(trace.attrs["p_time"])
-                s_time = datetime.fromisoformat(trace.attrs["s_time"])
-                p_arrival_index = int((p_time - anchor_time).total_seconds() * sampling_rate) + pre_window
-                s_arrival_index = int((s_time - anchor_time).total_seconds() * sampling_rate) + pre_window
-
-                begin_index = trace.attrs["p_idx"] - p_arrival_index
-                end_index = begin_index + pre_window + post_window
-                if begin_index < 0:
-                    print(trace.attrs["p_idx"], p_arrival_index, begin_index, end_index)
-                # if trace[begin_index:end_index,:].shape != (9000, 3):
-                #     print(trace.shape, p_arrival_index, begin_index, end_index)
-
-                waveform = np.zeros([pre_window + post_window, 3], dtype=np.float32)
-                waveform[: trace[max(0, begin_index) : max(0, end_index), :].shape[0], :] = (
-                    trace[max(0, begin_index) : max(0, end_index), :] * 1e6
+                group = fp_out.create_group(f"{event_id}")
+                group.attrs.update(event_attrs)
+                for station_id, waveform, _ in stations:
+                    fp_out[f"{event_id}/{station_id}"] = waveform
+                ## traces with fewer than three components get a 0 SNR for the missing ones
+                group.create_dataset(
+                    "stations",
+                    data=np.array(
+                        [
+                            (
+                                station_id,
+                                attrs["network"],
+                                attrs["station"],
+                                attrs["location"],
+                                attrs["distance_km"],
+                                attrs["azimuth"],
+                                attrs["emergence_angle"],
+                                attrs["latitude"],
+                                attrs["longitude"],
+                                attrs["elevation_m"],
+                                attrs["phase_index"][0],
+                                attrs["phase_index"][1],
+                                "".join(attrs["component"]),
+                                attrs["dt_s"],
+                                attrs["unit"],
+                                np.pad(attrs["snr"][:3], (0, 3 - len(attrs["snr"][:3]))),
+                                attrs["phase_time"],
+                                attrs["phase_score"],
+                                [str(x) for x in attrs["phase_remark"]],
+                                attrs["phase_polarity"],
+                            )
+                            for station_id, _, attrs in stations
+                        ],
+                        dtype=station_dtype,
+                    ),
                 )
-                network = trace.attrs["network"]
-                station = trace.attrs["station"]
-                location = trace.attrs["location_code"] if trace.attrs["location_code"] != "--" else ""
-                channels = trace.attrs["channels"].split(",")
-
-                begin_time = anchor_time - timedelta(seconds=pre_window / sampling_rate)
-                end_time = anchor_time + timedelta(seconds=post_window / sampling_rate)
-                distance_km = trace.attrs["distance_km"]
-                azimuth = trace.attrs["azimuth"]
-                p_polarity = trace.attrs["first_motion"]
-                if p_polarity not in ["U", "D"]:
-                    p_polarity = "N"
-                s_polarity = "N"
-                if has_polarity:
-                    station_id = f"{network}.{station}.{location}.{channels[0][:-1]}"
-                    station_ids = polarity.loc[event_id]["station_id"].values
-                    if station_id in station_ids:
-                        radiation = polarity.loc[event_id].loc[station_ids == station_id]
-                        p_radiation = radiation[radiation["phase_type"] == "P"]["radiation"].values[0]
-                        s_radiation = radiation[radiation["phase_type"] == "S"]["radiation"].values[0]
-                        p_radiation = round(p_radiation, 3)
-                        s_radiation = round(s_radiation, 3)
-                        if ((np.sign(p_radiation) > 0) and (p_polarity == "D")) or ((np.sign(p_radiation) < 0) and (p_polarity == "U")):
-                            print("P polarity is wrong", p_radiation, p_polarity, event_id, station_id)
-                            p_polarity = "N"
-                            s_polarity = "N"
-                        else:
-                            if np.sign(p_radiation) > 0:
-                                p_polarity = "U"
-                            elif np.sign(p_radiation) < 0:
-                                p_polarity = "D"
-                            else:
-                                print("P radiation is 0", p_radiation, p_polarity, event_id, station_id)
-                            if np.sign(s_radiation) > 0:
-                                s_polarity = "U"
-                            elif np.sign(s_radiation) < 0:
-                                s_polarity = "D"
-                            else:
-                                print("S radiation is 0", s_radiation, s_polarity, event_id, station_id)
-                    
-                emergence_angle = trace.attrs["emergence_angle"]
-                station_latitude = trace.attrs["station_latitude"]
-                station_longitude = trace.attrs["station_longitude"]
-                station_elevation_m = trace.attrs["station_elevation_m"]
-                dt_s = trace.attrs["dt"]
-                unit = trace.attrs["unit"]
-                snr = trace.attrs["snr"]
-                phase_type = ["P", "S"]
-                phase_index = [p_arrival_index, s_arrival_index]
-                phase_time = [p_time.isoformat(timespec="milliseconds"), s_time.isoformat(timespec="milliseconds")]
-                phase_score = [phase["p_weight"], phase["s_weight"]]
-                phase_remark = [phase["p_remark"], phase["s_remark"]]
-                phase_polarity = [p_polarity, s_polarity]
-                event_ids = [event_id, event_id]
-                assert dt_s == 1.0 / sampling_rate
-
-                station_id = f"{network}.{station}.{location}.{channels[0][:-1]}"
-                fp_out[f"{event_id}/{station_id}"] = waveform * 1e6
-                attrs = fp_out[f"{event_id}/{station_id}"].attrs
-                attrs["network"] = network
-                attrs["station"] = station
-                attrs["location"] = location
-                attrs["component"] = [x[-1] for x in channels]
-                attrs["distance_km"] = distance_km
-                attrs["azimuth"] = azimuth
-                attrs["emergence_angle"] = emergence_angle
-                attrs["latitude"] = station_latitude
-                attrs["longitude"] = station_longitude
-                attrs["elevation_m"] = station_elevation_m
-                attrs["dt_s"] = dt_s
-                attrs["unit"] = "1e-6" + unit
-                attrs["snr"] = SNR
-                attrs["phase_type"] = phase_type
-                attrs["phase_index"] = phase_index
-                attrs["phase_time"] = phase_time
-                attrs["phase_score"] = phase_score
-                attrs["phase_remark"] = phase_remark
-                attrs["phase_polarity"] = phase_polarity
-                attrs["event_id"] = event_ids
-
-                # print(begin_time, end_time)
-                # plt.plot(trace[begin_index:end_index,-1]/np.std(trace[begin_index:end_index,-1])/10 + j)
-                # plt.plot([(p_time - begin_time).total_seconds()*sampling_rate, (p_time - begin_time).total_seconds()*sampling_rate], [j-2, j+2], '--r')
-                # plt.plot([(s_time - begin_time).total_seconds()*sampling_rate, (s_time - begin_time).total_seconds()*sampling_rate], [j-2, j+2], '--b')
-
-            # if i > 2000:
-            #     break
 
 # plt.show()
 
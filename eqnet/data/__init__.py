@@ -1,3 +1,3 @@
 from .das import AutoEncoderIterableDataset, DASDataset, DASIterableDataset
 from .seismic_network import SeismicNetworkIterableDataset
-from .seismic_trace import SeismicTraceIterableDataset
+from .seismic_trace import SeismicTraceDataset, SeismicTraceIterableDataset, collate_batch
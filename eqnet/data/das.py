@@ -804,7 +804,7 @@ class DASIterableDataset(IterableDataset):
 
                     yield {
                         "data": torch.nan_to_num(data_),
-                        "phase_pick": targets_,
+                        "phase_pick": targets_.contiguous(),
                         "file_name": os.path.splitext(label_file.split("/")[-1])[0] + f"_{ii:02d}",
                         "height": data_.shape[-2],
                         "width": data_.shape[-1],
@@ -195,7 +195,8 @@ class QuakeFlow_NC(datasets.GeneratorBasedBuilder):
                 # for event_id in sorted(list(fp.keys())):
                 for event_id in fp.keys():
                     event = fp[event_id]
-                    station_ids = list(event.keys())
+                    stations = station_attrs(event)
+                    station_ids = list(stations.keys())
                     event_attrs = event.attrs
                     
                     if self.config.name=="NCEDC":
@@ -214,7 +215,7 @@ class QuakeFlow_NC(datasets.GeneratorBasedBuilder):
                     for i, sta_id in enumerate(station_ids):
                         # trace_id = event_id + "/" + sta_id
                         waveforms[:, :, i] = event[sta_id][:,:self.nt]
-                        attrs = event[sta_id].attrs
+                        attrs = stations[sta_id]
                         p_picks = attrs["phase_index"][attrs["phase_type"] == "P"]
                         s_picks = attrs["phase_index"][attrs["phase_type"] == "S"]
                         phase_pick[:, :, i] = generate_label([p_picks, s_picks], nt=self.nt)
@@ -298,6 +299,20 @@ class QuakeFlow_NC(datasets.GeneratorBasedBuilder):
                         }
 
 
+def station_attrs(event):
+    """Metadata of each station of an event keyed by station id: the rows of the event's "stations" table written by
+    datasets/NCEDC/build_datasets.py, or the attributes of each station trace in older files."""
+    if "stations" not in event:
+        return {sta_id: event[sta_id].attrs for sta_id in event.keys()}
+    stations = {}
+    for row in event["stations"][:]:
+        attrs = {name: (row[name].astype(str) if row[name].dtype.kind == "S" else row[name]) for name in row.dtype.names}
+        attrs["phase_type"] = np.array(["P", "S"])
+        attrs["phase_index"] = np.array([row["p_index"], row["s_index"]])
+        stations[str(attrs["station_id"])] = attrs
+    return stations
+
+
 def generate_label(phase_list, label_width=[150, 150], nt=8192):
 
     target = np.zeros([len(phase_list) + 1, nt], dtype=np.float32)
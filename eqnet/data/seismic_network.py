@@ -3,6 +3,8 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset, IterableDataset
 
+from .seismic_trace import station_attrs, station_keys
+
 
 def generate_label(phase_list, label_width=[150, 150], nt=8192):
     target = np.zeros([len(phase_list) + 1, nt], dtype=np.float32)
@@ -49,7 +51,7 @@ class SeismicNetworkIterableDataset(IterableDataset):
         while True:
             idx = np.random.randint(0, len(event_ids))
             event_id = event_ids[idx]
-            station_ids = list(self.hdf5_fp[event_id].keys())
+            station_ids = station_keys(self.hdf5_fp[event_id])
             if len(station_ids) < num_station:
                 continue
             else:
@@ -69,39 +71,39 @@ class SeismicNetworkIterableDataset(IterableDataset):
                 #     continue
 
                 data[:, :, i] = self.hdf5_fp[trace_id][: self.nt, :].T
-                attrs = self.hdf5_fp[trace_id].attrs
+                attrs = station_attrs(self.hdf5_fp, event_id, sta_id)
                 p_picks = attrs["phase_index"][attrs["phase_type"] == "P"]
                 s_picks = attrs["phase_index"][attrs["phase_type"] == "S"]
                 phase_pick[:, :, i] = generate_label([p_picks, s_picks], nt=self.nt)
 
                 ## TODO: how to deal with multiple phases
-                # center = (self.hdf5_fp[trace_id].attrs["phase_index"][::2] + self.hdf5_fp[trace_id].attrs["phase_index"][1::2])/2.0
+                # center = (attrs["phase_index"][::2] + attrs["phase_index"][1::2])/2.0
                 ## assuming only one event with both P and S picks
                 c0 = (
-                    (self.hdf5_fp[trace_id].attrs["phase_index"][attrs["phase_type"] == "P"])
-                    + (self.hdf5_fp[trace_id].attrs["phase_index"][attrs["phase_type"] == "S"])
+                    (attrs["phase_index"][attrs["phase_type"] == "P"])
+                    + (attrs["phase_index"][attrs["phase_type"] == "S"])
                 ) / 2.0
                 c0_width = (
                     (
-                        (self.hdf5_fp[trace_id].attrs["phase_index"][attrs["phase_type"] == "S"])
-                        - (self.hdf5_fp[trace_id].attrs["phase_index"][attrs["phase_type"] == "P"])
+                        (attrs["phase_index"][attrs["phase_type"] == "S"])
+                        - (attrs["phase_index"][attrs["phase_type"] == "P"])
                     )
                     * self.sampling_rate
                     / 200.0
                 ).max()
                 dx = round(
-                    (self.hdf5_fp[event_id].attrs["longitude"] - self.hdf5_fp[trace_id].attrs["longitude"])
+                    (self.hdf5_fp[event_id].attrs["longitude"] - attrs["longitude"])
                     * np.cos(np.radians(self.hdf5_fp[event_id].attrs["latitude"]))
                     * self.degree2km,
                     2,
                 )
                 dy = round(
-                    (self.hdf5_fp[event_id].attrs["latitude"] - self.hdf5_fp[trace_id].attrs["latitude"])
+                    (self.hdf5_fp[event_id].attrs["latitude"] - attrs["latitude"])
                     * self.degree2km,
                     2,
                 )
                 dz = round(
-                    self.hdf5_fp[event_id].attrs["depth_km"] + self.hdf5_fp[trace_id].attrs["elevation_m"] / 1e3,
+                    self.hdf5_fp[event_id].attrs["depth_km"] + attrs["elevation_m"] / 1e3,
                     2,
                 )
                 # dt = (c0 - self.hdf5_fp[event_id].attrs["event_time_index"]) / self.sampling_rate
@@ -133,13 +135,13 @@ class SeismicNetworkIterableDataset(IterableDataset):
 
                 ## station location
                 station_location[i, 0] = round(
-                    self.hdf5_fp[trace_id].attrs["longitude"]
-                    * np.cos(np.radians(self.hdf5_fp[trace_id].attrs["latitude"]))
+                    attrs["longitude"]
+                    * np.cos(np.radians(attrs["latitude"]))
                     * self.degree2km,
                     2,
                 )
-                station_location[i, 1] = round(self.hdf5_fp[trace_id].attrs["latitude"] * self.degree2km, 2)
-                station_location[i, 2] = round(-self.hdf5_fp[trace_id].attrs["elevation_m"] / 1e3, 2)
+                station_location[i, 1] = round(attrs["latitude"] * self.degree2km, 2)
+                station_location[i, 2] = round(-attrs["elevation_m"] / 1e3, 2)
 
             std = np.std(data, axis=1, keepdims=True)
             std[std == 0] = 1.0
@@ -6,7 +6,7 @@ AQ_PATH = os.path.abspath(os.path.join(__file__, "..", "..", ".."))
 sys.path.append(AQ_PATH)
 import random
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 from glob import glob
 from pathlib import Path
@@ -20,7 +20,7 @@ import obspy
 import pandas as pd
 import torch
 import torch.nn.functional as F
-from torch.utils.data import IterableDataset
+from torch.utils.data import Dataset, IterableDataset
 from tqdm import tqdm
 
 import warnings
@@ -42,6 +42,52 @@ def normalize(data):
     return data
 
 
+def station_keys(group):
+    ## datasets/NCEDC/build_datasets.py stores the event's station metadata table next to the station waveforms
+    return [key for key in group.keys() if key != "stations"]
+
+
+## station tables of recently read events, keyed by (file, event); bounded, since a worker samples across all events
+station_tables = OrderedDict()
+max_station_tables = 4096
+
+
+def station_table(hdf5_fp, event_id):
+    """The event's "stations" table read once and indexed by station id, or None for files that keep the metadata
+    in the attributes of each station trace."""
+    key = (hdf5_fp.filename, event_id)
+    if key in station_tables:
+        station_tables.move_to_end(key)
+        return station_tables[key]
+    table = None
+    if "stations" in hdf5_fp[event_id]:
+        rows = hdf5_fp[f"{event_id}/stations"][:]
+        table = {station_id.decode(): row for station_id, row in zip(rows["station_id"], rows)}
+    station_tables[key] = table
+    if len(station_tables) > max_station_tables:
+        station_tables.popitem(last=False)
+    return table
+
+
+def station_attrs(hdf5_fp, event_id, station_id):
+    """Metadata of one station trace: the trace's own attributes or, for files written with the per-event
+    "stations" table, that station's row in the table, in the same attribute layout."""
+    table = station_table(hdf5_fp, event_id)
+    if table is None:
+        return hdf5_fp[f"{event_id}/{station_id}"].attrs
+    row = table[station_id]
+    attrs = {name: (row[name].astype(str) if row[name].dtype.kind == "S" else row[name]) for name in row.dtype.names}
+    attrs["phase_type"] = np.array(["P", "S"])
+    attrs["phase_index"] = np.array([row["p_index"], row["s_index"]])
+    attrs["event_id"] = np.array([event_id, event_id])
+    return attrs
+
+
+def to_tensor(x):
+    ## cast and pack strided views in one pass, so the collate step stacks dense float32 buffers
+    return torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+
+
 def padding(data, min_nt=1024, min_nx=1):
     nch, nt, nx = data.shape
     pad_nt = (min_nt - nt % min_nt) % min_nt
@@ -406,9 +452,9 @@ class SeismicTraceIterableDataset(IterableDataset):
                 with h5py.File(hdf5_file, "r", libver="latest", swmr=True) as fp:
                     self.data_list = []
                     for event in tqdm(list(fp.keys()), desc="Caching HDF5 keys"):
-                        for station in list(fp[event].keys()):
+                        for station in station_keys(fp[event]):
                             if training:
-                                attrs = dict(fp[event][station].attrs)
+                                attrs = dict(station_attrs(fp, event, station))
                                 if ("component" in attrs) and ("snr" in attrs):
                                     if (attrs["component"] == "ENZ") and (max(attrs["snr"]) > 2.0):  ## filtering
                                         self.data_list.append(event + "/" + station)
@@ -591,7 +637,7 @@ class SeismicTraceIterableDataset(IterableDataset):
         nch, nt = waveform.shape
 
         ## phase picks
-        attrs = hdf5_fp[trace_id].attrs
+        attrs = station_attrs(hdf5_fp, event_id, sta_id)
         meta = {}
         for phase in self.phases:
             meta[phase] = attrs["phase_index"][attrs["phase_type"] == phase]
@@ -714,71 +760,79 @@ class SeismicTraceIterableDataset(IterableDataset):
 
     def sample_train(self, data_list):
         hdf5_fp = h5py.File(self.hdf5_file, "r", libver="latest", swmr=True)
+        ## np.random.choice converts the whole list of trace ids to an array on every call; draw an index instead
         while True:
-            trace_id = np.random.choice(data_list)
-            try:
-                meta = self.read_training_h5(trace_id, hdf5_fp)
-            except Exception as e:
-                print(f"Error reading {trace_id}:\n{e}")
+            trace_id = data_list[np.random.randint(len(data_list))]
+            sample = self.read_training_sample(trace_id, hdf5_fp)
+            if sample is None:
                 continue
+            yield {k: to_tensor(v) for k, v in sample.items()}
 
-            if meta is None:
-                continue
+        hdf5_fp.close()
 
-            # if self.stack_event and (random.random() < 0.6):
-            if self.stack_event:
-                try:
-                    trace_id2 = np.random.choice(self.data_list)
-                    meta2 = self.read_training_h5(trace_id2, hdf5_fp)
-                    if meta2 is not None:
-                        meta = stack_event(meta, meta2)
-                except Exception as e:
-                    print(f"Error reading {trace_id2}:\n{e}")
+    def read_training_sample(self, trace_id, hdf5_fp):
+        """One augmented training example as numpy arrays, or None if the trace fails to load or is filtered out."""
+        try:
+            meta = self.read_training_h5(trace_id, hdf5_fp)
+        except Exception as e:
+            print(f"Error reading {trace_id}:\n{e}")
+            return None
 
-            meta = cut_data(meta, min_point=self.phase_width[0] * 2)
-            if self.flip_polarity and (random.random() < 0.5):
-                meta = flip_polarity(meta)
+        if meta is None:
+            return None
 
-            if np.std(meta["waveform"], axis=(1, 2))[-1] == 0:
-                ## polarity is picked by the last channel
-                # print(f"Error reading {trace_id}: zeros in Z channel {np.std(meta['waveform'], axis=(1,2))}")
-                meta["polarity_mask"] = np.zeros_like(meta["polarity_mask"])
+        # if self.stack_event and (random.random() < 0.6):
+        if self.stack_event:
+            try:
+                trace_id2 = self.data_list[np.random.randint(len(self.data_list))]
+                meta2 = self.read_training_h5(trace_id2, hdf5_fp)
+                if meta2 is not None:
+                    meta = stack_event(meta, meta2)
+            except Exception as e:
+                print(f"Error reading {trace_id2}:\n{e}")
 
-            if self.drop_channel and (random.random() < 0.1):
-                meta = drop_channel(meta)
+        meta = cut_data(meta, min_point=self.phase_width[0] * 2)
+        if self.flip_polarity and (random.random() < 0.5):
+            meta = flip_polarity(meta)
 
-            if (np.std(meta["waveform"], axis=(1, 2)) == 0).all():
-                # print(f"Error reading {trace_id}: all zeros {np.std(meta['waveform'], axis=(1,2))}")
-                continue
+        if np.std(meta["waveform"], axis=(1, 2))[-1] == 0:
+            ## polarity is picked by the last channel
+            # print(f"Error reading {trace_id}: zeros in Z channel {np.std(meta['waveform'], axis=(1,2))}")
+            meta["polarity_mask"] = np.zeros_like(meta["polarity_mask"])
 
-            waveform = meta["waveform"]
-            # waveform = normalize(waveform)
-            phase_pick = meta["phase_pick"]
-            phase_mask = meta["phase_mask"][np.newaxis, ::]
-            event_center = meta["event_center"][np.newaxis, :: self.event_feature_scale]
-            # polarity = meta["polarity"][np.newaxis, :: self.polarity_feature_scale]
-            # polarity_mask = meta["polarity_mask"][np.newaxis, :: self.polarity_feature_scale]
-            # polarity = meta["polarity"][:, :: self.polarity_feature_scale, :]
-            # polarity_mask = meta["polarity_mask"][:: self.polarity_feature_scale, :]
-            polarity = meta["polarity"][:, :: self.polarity_feature_scale]
-            polarity_mask = meta["polarity_mask"][np.newaxis, ::]
-            event_time = meta["event_time"][np.newaxis, :: self.event_feature_scale]
-            event_mask = meta["event_mask"][np.newaxis, :: self.event_feature_scale]
-            station_location = meta["station_location"]
-
-            yield {
-                "data": torch.from_numpy(waveform).float(),
-                "phase_pick": torch.from_numpy(phase_pick).float(),
-                "phase_mask": torch.from_numpy(phase_mask).float(),
-                "event_center": torch.from_numpy(event_center).float(),
-                "event_time": torch.from_numpy(event_time).float(),
-                "event_mask": torch.from_numpy(event_mask).float(),
-                "station_location": torch.from_numpy(station_location).float(),
-                "polarity": torch.from_numpy(polarity).float(),
-                "polarity_mask": torch.from_numpy(polarity_mask).float(),
-            }
+        if self.drop_channel and (random.random() < 0.1):
+            meta = drop_channel(meta)
 
-        hdf5_fp.close()
+        if (np.std(meta["waveform"], axis=(1, 2)) == 0).all():
+            # print(f"Error reading {trace_id}: all zeros {np.std(meta['waveform'], axis=(1,2))}")
+            return None
+
+        waveform = meta["waveform"]
+        # waveform = normalize(waveform)
+        phase_pick = meta["phase_pick"]
+        phase_mask = meta["phase_mask"][np.newaxis, ::]
+        event_center = meta["event_center"][np.newaxis, :: self.event_feature_scale]
+        # polarity = meta["polarity"][np.newaxis, :: self.polarity_feature_scale]
+        # polarity_mask = meta["polarity_mask"][np.newaxis, :: self.polarity_feature_scale]
+        # polarity = meta["polarity"][:, :: self.polarity_feature_scale, :]
+        # polarity_mask = meta["polarity_mask"][:: self.polarity_feature_scale, :]
+        polarity = meta["polarity"][:, :: self.polarity_feature_scale]
+        polarity_mask = meta["polarity_mask"][np.newaxis, ::]
+        event_time = meta["event_time"][np.newaxis, :: self.event_feature_scale]
+        event_mask = meta["event_mask"][np.newaxis, :: self.event_feature_scale]
+        station_location = meta["station_location"]
+
+        return {
+            "data": waveform,
+            "phase_pick": phase_pick,
+            "phase_mask": phase_mask,
+            "event_center": event_center,
+            "event_time": event_time,
+            "event_mask": event_mask,
+            "station_location": station_location,
+            "polarity": polarity,
+            "polarity_mask": polarity_mask,
+        }
 
     def taper(stream):
         for tr in stream:
@@ -1057,6 +1111,44 @@ class SeismicTraceIterableDataset(IterableDataset):
                         }
 
 
+class SeismicTraceDataset(Dataset):
+    """Map-style view of the hdf5 training samples of SeismicTraceIterableDataset, taking the same arguments.
+
+    The DataLoader hands each batch of indices to ``__getitems__``, which returns the batch already stacked, so there
+    is one fetch per batch instead of one per trace; load it with ``collate_fn=collate_batch``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.dataset = SeismicTraceIterableDataset(*args, **kwargs)
+        self.data_list = self.dataset.data_list
+        self.hdf5_fp = None
+
+    def __len__(self):
+        return len(self.data_list)
+
+    def __getitem__(self, idx):
+        return {k: v[0] for k, v in self.__getitems__([idx]).items()}
+
+    def __getitems__(self, indices):
+        if self.hdf5_fp is None:
+            ## opened on first use, so that every loader worker has its own handle
+            self.hdf5_fp = h5py.File(self.dataset.hdf5_file, "r", libver="latest", swmr=True)
+        samples = []
+        for idx in indices:
+            sample = self.dataset.read_training_sample(self.data_list[idx], self.hdf5_fp)
+            ## as in sample_train, traces that fail to load or are filtered out are replaced by random ones
+            while sample is None:
+                trace_id = self.data_list[np.random.randint(len(self.data_list))]
+                sample = self.dataset.read_training_sample(trace_id, self.hdf5_fp)
+            samples.append(sample)
+        return {k: to_tensor(np.stack([sample[k] for sample in samples])) for k in samples[0]}
+
+
+def collate_batch(batch):
+    ## SeismicTraceDataset.__getitems__ already returns a stacked batch
+    return batch
+
+
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
 
@@ -302,6 +302,7 @@ class PhaseNet(nn.Module):
         event_center_loss_weight=1.0,
         event_time_loss_weight=1.0,
         polarity_loss_weight=1.0,
+        gradient_checkpointing=False,
     ) -> None:
         super().__init__()
         self.backbone_name = backbone
@@ -316,7 +317,12 @@ class PhaseNet(nn.Module):
         elif backbone == "resnet50":
             self.backbone = ResNet(Bottleneck, [3, 4, 6, 3])  # ResNet50
         elif backbone == "unet":
-            self.backbone = UNet(log_scale=log_scale, add_polarity=add_polarity, add_event=add_event)
+            self.backbone = UNet(
+                log_scale=log_scale,
+                add_polarity=add_polarity,
+                add_event=add_event,
+                gradient_checkpointing=gradient_checkpointing,
+            )
         else:
             raise ValueError("backbone only supports resnet18, resnet50, or unet")
 
@@ -383,7 +389,8 @@ class PhaseNet(nn.Module):
 def build_model(
     backbone="unet",
     log_scale=True,
+    gradient_checkpointing=False,
     *args,
     **kwargs,
 ) -> PhaseNet:
-    return PhaseNet(backbone=backbone, log_scale=log_scale)
+    return PhaseNet(backbone=backbone, log_scale=log_scale, gradient_checkpointing=gradient_checkpointing)
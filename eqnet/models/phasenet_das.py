@@ -127,7 +127,7 @@ class PhaseNetDAS(nn.Module):
         return {"phase": phase, "loss": loss}
 
 
-def build_model(in_channels=1, out_channels=3, reg=0.0, *args, **kwargs) -> PhaseNetDAS:
+def build_model(in_channels=1, out_channels=3, reg=0.0, gradient_checkpointing=False, *args, **kwargs) -> PhaseNetDAS:
     backbone = UNet(
         in_channels=in_channels,
         out_channels=out_channels,
@@ -137,6 +137,7 @@ def build_model(in_channels=1, out_channels=3, reg=0.0, *args, **kwargs) -> Phas
         stride=(4, 4),
         padding=(3, 3),
         moving_norm=(2048, 256),
+        gradient_checkpointing=gradient_checkpointing,
     )
 
     classifier = UNetHead(in_channels=16, out_channels=out_channels, kernel_size=(7, 7), padding=(3, 3), reg=reg)
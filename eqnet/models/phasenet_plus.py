@@ -9,6 +9,7 @@ def build_model(
     event_center_loss_weight=1.0,
     event_time_loss_weight=1.0,
     polarity_loss_weight=0.2,
+    gradient_checkpointing=False,
     *args,
     **kwargs,
 ) -> PhaseNet:
@@ -20,4 +21,5 @@ def build_model(
         event_center_loss_weight=event_center_loss_weight,
         event_time_loss_weight=event_time_loss_weight,
         polarity_loss_weight=polarity_loss_weight,
+        gradient_checkpointing=gradient_checkpointing,
     )
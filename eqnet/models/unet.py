@@ -1,8 +1,25 @@
 from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def frozen_batchnorm_stats(module):
+    ## the recompute runs BatchNorm in training mode a second time; zero momentum keeps the running stats unchanged
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
 
 default_cfgs = {}
 
@@ -28,7 +45,8 @@ def moving_normalize(data, filter=1024, stride=128):
         data_ = F.pad(data, (0, 0, padding, padding), mode="reflect")
         mean = F.avg_pool2d(data_, kernel_size=(filter, 1), stride=(stride, 1))
         mean = F.interpolate(mean, scale_factor=(stride, 1), mode="bilinear", align_corners=False)[:, :, :nt, :nx]
-        data -= mean
+        ## out of place: the input may be the caller's batch, e.g. the prefetched waveforms that are plotted later
+        data = data - mean
 
         # data_ = F.pad(data, (0, 0, pad1, pad2), mode="reflect")
         data_ = F.pad(data, (0, 0, padding, padding), mode="reflect")
@@ -116,6 +134,7 @@ class UNet(nn.Module):
         add_event=False,
         add_stft=False,
         log_scale=False,
+        gradient_checkpointing=False,
     ):
         super(UNet, self).__init__()
 
@@ -125,6 +144,7 @@ class UNet(nn.Module):
         self.add_stft = add_stft
         self.moving_norm = moving_norm
         self.log_scale = log_scale
+        self.gradient_checkpointing = gradient_checkpointing
 
         self.input_conv = self.encoder_block(
             in_channels, features, kernel_size=kernel_size, stride=init_stride, padding=padding, name="enc1"
@@ -271,16 +291,16 @@ class UNet(nn.Module):
         if self.add_polarity:
             enc_polarity = self.encoder_polarity(x[:, -1:, :, :])  ## last channel is vertical component
 
-        enc1 = self.input_conv(x)
-        enc2 = self.encoder12(enc1)
-        enc3 = self.encoder23(enc2)
-        enc4 = self.encoder34(enc3)
-        enc5 = self.encoder45(enc4)
+        enc1 = self.run_block(self.input_conv, x)
+        enc2 = self.run_block(self.encoder12, enc1)
+        enc3 = self.run_block(self.encoder23, enc2)
+        enc4 = self.run_block(self.encoder34, enc3)
+        enc5 = self.run_block(self.encoder45, enc4)
 
         dec4 = self.upconv54(enc5)
 
         dec4 = torch.cat((dec4, enc4), dim=1)
-        dec3 = self.decoder43(dec4)
+        dec3 = self.run_block(self.decoder43, dec4)
         if self.add_event:
             out_event = self.output_event(dec3)
             if self.output_upsample is not None:
@@ -291,9 +311,9 @@ class UNet(nn.Module):
         else:
             out_event = None
         dec3 = torch.cat((dec3, enc3), dim=1)
-        dec2 = self.decoder32(dec3)
+        dec2 = self.run_block(self.decoder32, dec3)
         dec2 = torch.cat((dec2, enc2), dim=1)
-        dec1 = self.decoder21(dec2)
+        dec1 = self.run_block(self.decoder21, dec2)
         if self.add_polarity:
             dec_polarity = torch.cat((dec1, enc_polarity), dim=1)
             out_polarity = self.output_polarity(dec_polarity)
@@ -315,6 +335,18 @@ class UNet(nn.Module):
 
         return result
 
+    def run_block(self, block, x):
+        ## with gradient checkpointing, a block's inner activations are recomputed in backward instead of stored;
+        ## only the block outputs, which the skip connections need anyway, are kept
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(
+                block,
+                x,
+                use_reentrant=False,
+                context_fn=lambda: (nullcontext(), frozen_batchnorm_stats(block)),
+            )
+        return block(x)
+
     @staticmethod
     def encoder_block(in_channels, out_channels, kernel_size=(7, 7), stride=(4, 4), padding=(3, 3), name=""):
         return nn.Sequential(
@@ -1,7 +1,9 @@
 import os
 import shutil
 from collections import defaultdict
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from glob import glob
 from pathlib import Path
 
@@ -14,28 +16,106 @@ import torch.nn.functional as F
 from tqdm import tqdm
 
 
-def detect_peaks(scores, vmin=0.3, kernel=101, stride=1, K=0, dt=0.01):
+def _max_pool_time(x, kernel, stride, pad):
+    """1D max pooling along the last (time) axis."""
+    shape = x.shape
+    x = F.max_pool1d(x.reshape(-1, 1, shape[-1]), kernel, stride=stride, padding=pad)[:, :, : shape[-1]]
+    return x.reshape(shape)
+
+
+## one device-to-host copy stream per device, created on first use
+_copy_streams = {}
+
+
+def _no_wait():
+    pass
+
+
+def to_host_async(*tensors, buffers=None):
+    """Start copying tensors to pinned host memory on a side stream; None is passed through.
+
+    Returns the host tensors and a wait() callable; the host tensors may only be read after wait() returns, so the
+    caller can queue more GPU work in between. buffers is an optional list of pinned tensors kept by the caller; a
+    buffer is reused when its shape and dtype match, otherwise it is replaced in the list, and the returned tensors
+    are overwritten by the next call with the same list.
+    """
+    device = next(x.device for x in tensors if x is not None)
+    if device.type != "cuda":
+        return tuple(x.detach().cpu() if x is not None else None for x in tensors), _no_wait
+    if device not in _copy_streams:
+        _copy_streams[device] = torch.cuda.Stream(device=device)
+    copy_stream = _copy_streams[device]
+    copy_stream.wait_stream(torch.cuda.current_stream(device))
+    if buffers is None:
+        buffers = []
+    buffers.extend([None] * (len(tensors) - len(buffers)))
+    for i, x in enumerate(tensors):
+        if x is None:
+            continue
+        if (buffers[i] is None) or (buffers[i].shape != x.shape) or (buffers[i].dtype != x.dtype):
+            buffers[i] = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+    host = tuple(buffers[i] if x is not None else None for i, x in enumerate(tensors))
+    with torch.cuda.stream(copy_stream):
+        for x, y in zip(tensors, host):
+            if x is None:
+                continue
+            x.record_stream(copy_stream)
+            y.copy_(x.detach(), non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record(copy_stream)
+    return host, copied.synchronize
+
+
+def to_host(*tensors, buffers=None):
+    """Copy tensors to pinned host memory and wait for the copies; see to_host_async."""
+    host, wait = to_host_async(*tensors, buffers=buffers)
+    wait()
+    return host
+
+
+def quantize_scores(scores):
+    ## scores in [0, 1] are only drawn when plotting, so 8 bits are enough and a quarter of the bytes cross PCIe
+    if scores is None:
+        return None
+    return (scores.clamp(0, 1) * 255).round().to(torch.uint8)
+
+
+def dequantize_scores(scores):
+    if scores is None:
+        return None
+    return scores.float() / 255
+
+
+def find_peaks(scores, vmin=0.3, kernel=101, stride=1, K=0, dt=0.01, fill_value=0.0):
+    """Device-side part of detect_peaks; returns the top-k scores and indices without copying them to the host.
+
+    fill_value replaces the suppressed (non-peak) scores; use -inf when scores are logits rather than probabilities.
+    """
     nb, nc, nt, nx = scores.shape
     pad = kernel // 2
-    smax = F.max_pool2d(scores, (kernel, 1), stride=(stride, 1), padding=(pad, 0))[:, :, :nt, :]
-    keep = (smax == scores).float()
-    scores = scores * keep
+    ## peaks of the noise channel are never returned, so drop it before any full-size pass
+    if nc > 1:
+        scores = scores[:, 1:, :, :]
+    scores = torch.transpose(scores, 2, 3).contiguous()  # [nb, nc, nt, nx] -> [nb, nc, nx, nt]
+    smax = _max_pool_time(scores, kernel, stride, pad)
+    keep = smax == scores
+    fill = scores.new_full((), fill_value)
+    scores = torch.where(keep, scores, fill)
     # if there are multiple peaks with the same score, keep the first one
-    pos = torch.arange(nt, 0, -1, device=scores.device)[None, None, :, None].float()
-    sfirst = F.max_pool2d(keep * pos, (kernel, 1), stride=(stride, 1), padding=(pad, 0))[:, :, :nt, :]
-    scores = scores * (sfirst == pos).float()
+    pos = torch.arange(nt, 0, -1, device=scores.device).float()
+    sfirst = _max_pool_time(torch.where(keep, pos, pos.new_zeros(())), kernel, stride, pad)
+    scores = torch.where(sfirst == pos, scores, fill)
 
-    batch, chn, nt, ns = scores.size()
-    scores = torch.transpose(scores, 2, 3)  # [nb, nc, nt, nx] -> [nb, nc, nx, nt]
     if K == 0:
         K = max(round(nt / (30.0 / dt) * 10.0), 3)  # maximum 10 picks per 30 seconds
-    if chn == 1:
-        topk_scores, topk_inds = torch.topk(scores, K)
-    else:
-        topk_scores, topk_inds = torch.topk(scores[:, 1:, :, :].view(batch, chn - 1, ns, -1), K)
+    topk_scores, topk_inds = torch.topk(scores, K)
     # topk_inds = topk_inds % nt
 
-    return topk_scores.detach().cpu(), topk_inds.detach().cpu()
+    return topk_scores, topk_inds
+
+
+def detect_peaks(scores, vmin=0.3, kernel=101, stride=1, K=0, dt=0.01):
+    return to_host(*find_peaks(scores, vmin=vmin, kernel=kernel, stride=stride, K=K, dt=dt))
 
 
 def extract_picks(
@@ -68,7 +148,6 @@ def extract_picks(
     batch, nch, nst, ntopk = topk_score.shape
     # assert nch == len(phases)
 
-    picks = []
     if isinstance(dt, float):
         dt = [dt for i in range(batch)]
     else:
@@ -82,20 +161,8 @@ def extract_picks(
     else:
         begin_time_index = [0 for i in range(batch)]
 
-    if waveform is not None:
-        waveform_amp = torch.max(torch.abs(waveform), dim=1)[0]
-        # waveform_amp = torch.sqrt(torch.mean(waveform ** 2, dim=1))
-
-        if len(window_amp) == 1:
-            window_amp = [window_amp[0] for i in range(len(phases))]
-
+    begin_datetime64 = []
     for i in range(batch):
-        picks_per_file = []
-        if file_name is None:
-            file_i = f"{i:04d}"
-        else:
-            file_i = file_name[i]
-
         if begin_time is None:
             begin_i = "1970-01-01T00:00:00.000"
         else:
@@ -103,61 +170,98 @@ def extract_picks(
             if len(begin_i) == 0:
                 begin_i = "1970-01-01T00:00:00.000"
         begin_i = datetime.fromisoformat(begin_i.rstrip("Z"))
+        if begin_i.tzinfo is not None:
+            ## datetime64 has no time zone; shift offset-aware begin times to UTC before dropping the offset
+            begin_i = begin_i.astimezone(timezone.utc).replace(tzinfo=None)
+        begin_datetime64.append(np.datetime64(begin_i, "us"))
+
+    ## sort the topk picks by time and select all picks above vmin at once: [N, 4] "batch, channel, station, topk"
+    topk_index, ii = torch.sort(topk_index, dim=-1)
+    topk_score = torch.gather(topk_score, -1, ii)
+    mask = topk_score > vmin
+    ijk = mask.nonzero(as_tuple=False)
+    pick_index = topk_index[mask]
+    pick_score = topk_score[mask]
+    ib, ic, ist = ijk[:, 0], ijk[:, 1], ijk[:, 2]
+    if len(pick_index) == 0:
+        return [[] for i in range(batch)]
+
+    if polarity_score is not None:
+        ## polarity score with the largest magnitude within [-3, 3) samples around the pick
+        polarity_diff = polarity_score[:, 1, :, :] - polarity_score[:, 2, :, :]  # [batch, nt, nsta]
+        nt_polarity = polarity_diff.shape[1]
+        device = polarity_diff.device
+        center = (pick_index // polarity_scale).to(device)
+        offset = center[:, None] + torch.arange(-3, 3, device=device)[None, :]
+        valid = (offset >= 0) & (offset < nt_polarity)
+        polarity_window = polarity_diff[
+            ib.to(device)[:, None], offset.clamp(0, nt_polarity - 1), ist.to(device)[:, None]
+        ].masked_fill(~valid, 0)
+        idx = torch.argmax(torch.abs(polarity_window), dim=1, keepdim=True)
+        pick_polarity = torch.gather(polarity_window, 1, idx)[:, 0].cpu().tolist()
 
-        for j in range(nch):
-            if waveform is not None:
-                window_amp_i = int(window_amp[j] / dt[i])  ## index of window
-
-            for k in range(nst):
-                if station_id is None:
-                    station_i = f"{k + begin_channel_index[i]:04d}"
-                else:
-                    station_i = station_id[k][i]
+    if waveform is not None:
+        if len(window_amp) == 1:
+            window_amp = [window_amp[0] for i in range(len(phases))]
 
-                topk_index_ijk, ii = torch.sort(topk_index[i, j, k])
-                topk_score_ijk = topk_score[i, j, k][ii]
+        ## maximum amplitude from the pick to min(pick + window, next pick) of the same channel and station
+        waveform_amp = torch.max(torch.abs(waveform), dim=1)[0]  # [batch, nt, nsta]
+        # waveform_amp = torch.sqrt(torch.mean(waveform ** 2, dim=1))
+        nt = waveform_amp.shape[1]
+        device = waveform_amp.device
+        window_amp_i = (
+            torch.tensor(window_amp[:nch], dtype=torch.float64)[ic] / torch.tensor(dt, dtype=torch.float64)[ib]
+        ).long()
+        j1 = pick_index
+        j2 = j1 + window_amp_i
+        group = (ib * nch + ic) * nst + ist
+        has_next = torch.zeros_like(group, dtype=torch.bool)
+        has_next[:-1] = group[1:] == group[:-1]
+        next_index = torch.roll(j1, -1)
+        j2 = torch.where(has_next, torch.minimum(j2, next_index), j2)
+
+        max_window = max(int(window_amp_i.max().item()), 1)
+        offset = (j1[:, None] + torch.arange(max_window)[None, :]).to(device)
+        valid = (offset < j2.to(device)[:, None]) & (offset < nt)
+        flat_index = (ib.to(device)[:, None] * nst + ist.to(device)[:, None]) * nt + offset.clamp(0, nt - 1)
+        amplitude = waveform_amp.permute(0, 2, 1).reshape(-1)[flat_index].masked_fill(~valid, 0)
+        pick_amplitude = torch.max(amplitude, dim=1)[0].cpu().tolist()
+
+    ## pick times in microseconds, formatted with millisecond precision
+    ib_np, pick_index_np = ib.numpy(), pick_index.numpy()
+    pick_time = np.array(begin_datetime64)[ib_np] + np.round(
+        pick_index_np * np.array(dt, dtype=np.float64)[ib_np] * 1e6
+    ).astype("timedelta64[us]")
+    pick_time = np.datetime_as_string(pick_time, unit="ms").tolist()
+
+    ## build whole columns first and only zip them into one dict per pick at the end
+    ib_list = ib.tolist()
+    if station_id is None:
+        channel_index = (ist + torch.tensor(begin_channel_index)[ib]).tolist()
+        station_ids = [f"{k:04d}" for k in channel_index]
+    else:
+        station_ids = [station_id[k][i] for i, k in zip(ib_list, ist.tolist())]
+    columns = {
+        # "file_name": file_i,
+        "station_id": station_ids,
+        "phase_index": (pick_index + torch.tensor(begin_time_index)[ib]).tolist(),
+        "phase_time": pick_time,
+        "phase_score": [round(x, 3) for x in pick_score.tolist()],
+        "phase_type": np.array(phases, dtype=object)[ic.numpy()].tolist(),
+        "dt_s": np.array(dt)[ib_np].tolist(),
+    }
+    if station_id is None:
+        columns["channel_index"] = channel_index
+    if polarity_score is not None:
+        columns["phase_polarity"] = [round(x, 3) for x in pick_polarity]
+    if waveform is not None:
+        columns["phase_amplitude"] = [f"{x:.3e}" for x in pick_amplitude]
 
-                idx = topk_score_ijk > vmin
-                topk_index_ijk = topk_index_ijk[idx]
-                topk_score_ijk = topk_score_ijk[idx]
+    keys = list(columns.keys())
+    picks = [[] for i in range(batch)]
+    for i, values in zip(ib_list, zip(*columns.values())):
+        picks[i].append(dict(zip(keys, values)))
 
-                # for ii, (index, score) in enumerate(zip(topk_index[i, j, k], topk_score[i, j, k])):
-                for ii, (index, score) in enumerate(zip(topk_index_ijk, topk_score_ijk)):
-                    # if score > vmin:
-                    pick_index = index.item() + begin_time_index[i]
-                    pick_time = (begin_i + timedelta(seconds=index.item() * dt[i])).isoformat(timespec="milliseconds")
-                    pick_dict = {
-                        # "file_name": file_i,
-                        "station_id": station_i,
-                        "phase_index": pick_index,
-                        "phase_time": pick_time,
-                        "phase_score": f"{score.item():.3f}",
-                        "phase_type": phases[j],
-                        "dt_s": dt[i],
-                    }
-
-                    if polarity_score is not None:
-                        # pick_dict["phase_polarity"] = (
-                        #     f"{(polarity_score[i, 1, index.item()//polarity_scale, k].item() - polarity_score[i, 2, index.item()//polarity_scale, k].item()):.3f}"
-                        # )
-                        score = polarity_score[i, 1, :, k] - polarity_score[i, 2, :, k]
-                        # score = (polarity_score[i, 0, :, k] - 0.5) * 2.0
-                        score = score[max(0, index.item() // polarity_scale - 3) : index.item() // polarity_scale + 3]
-                        idx = torch.argmax(torch.abs(score))
-                        pick_dict["phase_polarity"] = round(score[idx].item(), 3)
-
-                    if waveform is not None:
-                        j1 = topk_index_ijk[ii]
-                        j2 = (
-                            min(j1 + window_amp_i, topk_index_ijk[ii + 1])
-                            if ii < len(topk_index_ijk) - 1
-                            else j1 + window_amp_i
-                        )
-                        pick_dict["phase_amplitude"] = f"{torch.max(waveform_amp[i, j1:j2, k]).item():.3e}"
-
-                    picks_per_file.append(pick_dict)
-
-        picks.append(picks_per_file)
     return picks
 
 
@@ -205,6 +309,10 @@ def extract_events(
     else:
         begin_time_index = [0 for i in range(batch)]
 
+    ## sort the topk events by time once instead of per station
+    topk_index, ii = torch.sort(topk_index, dim=-1)
+    topk_score = torch.gather(topk_score, -1, ii)
+
     for i in range(batch):
         events_per_file = []
         # if file_name is None:
@@ -230,8 +338,8 @@ def extract_events(
                 else:
                     station_i = station_id[k][i]
 
-                topk_index_ijk, ii = torch.sort(topk_index[i, j, k])
-                topk_score_ijk = topk_score[i, j, k][ii]
+                topk_index_ijk = topk_index[i, j, k]
+                topk_score_ijk = topk_score[i, j, k]
 
                 # for ii, (index, score) in enumerate(zip(topk_index[i, j, k], topk_score[i, j, k])):
                 for ii, (index, score) in enumerate(zip(topk_index_ijk, topk_score_ijk)):
@@ -286,29 +394,29 @@ def extract_events(
     return events
 
 
-def merge_picks(pick_dir):
+def _read_files(files, desc, num_workers=None, format="csv"):
+    """Read the non-empty csv/parquet files in a thread pool; both readers release the GIL for most of the work."""
+    files = [file for file in files if os.stat(file).st_size > 0]
+    reader = {"csv": partial(pd.read_csv, engine="c"), "parquet": pd.read_parquet}[format]
+    if num_workers is None:
+        num_workers = min(32, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(tqdm(executor.map(reader, files), total=len(files), desc=desc))
+
+
+def merge_picks(pick_dir, num_workers=None, format="csv"):
     pick_dir = Path(pick_dir)
 
     num_p = 0
     num_s = 0
-    picks = []
-    for file in tqdm(
-        pick_dir.rglob(
-            "*.csv",
-        ),
-        desc=f"Merging {pick_dir.name}",
-    ):
-        if os.stat(file).st_size == 0:
-            continue
-        picks_ = pd.read_csv(file)
-        num_p += len(picks_[picks_["phase_type"] == "P"])
-        num_s += len(picks_[picks_["phase_type"] == "S"])
-        picks.append(picks_)
+    picks = _read_files(pick_dir.rglob(f"*.{format}"), f"Merging {pick_dir.name}", num_workers, format)
     if len(picks) == 0:
         with open(str(pick_dir) + ".csv", "w") as fp:
             fp.write("")
     else:
         picks = pd.concat(picks)
+        num_p = (picks["phase_type"] == "P").sum()
+        num_s = (picks["phase_type"] == "S").sum()
         picks = picks.sort_values(["phase_time", "station_id", "phase_type"])
         picks = picks.reset_index(drop=True)
         picks.to_csv(str(pick_dir) + ".csv", index=False)
@@ -320,20 +428,10 @@ def merge_picks(pick_dir):
     return 0
 
 
-def merge_events(event_dir):
+def merge_events(event_dir, num_workers=None, format="csv"):
     event_dir = Path(event_dir)
 
-    events = []
-    for file in tqdm(
-        event_dir.rglob(
-            "*.csv",
-        ),
-        desc=f"Merging {event_dir.name}",
-    ):
-        if os.stat(file).st_size == 0:
-            continue
-        events_ = pd.read_csv(file)
-        events.append(events_)
+    events = _read_files(event_dir.rglob(f"*.{format}"), f"Merging {event_dir.name}", num_workers, format)
     if len(events) == 0:
         with open(str(event_dir) + ".csv", "w") as fp:
             fp.write("")
@@ -347,7 +445,45 @@ def merge_events(event_dir):
     return 0
 
 
-def merge_patch(patch_dir, merged_dir, return_single_file=False):
+def _copy_lines(src, dsts, length=1 << 20):
+    """Copy the rest of a binary file to all destinations in blocks and return the number of lines copied."""
+    num_lines = 0
+    last = b"\n"
+    while True:
+        buf = src.read(length)
+        if not buf:
+            break
+        for dst in dsts:
+            dst.write(buf)
+        num_lines += buf.count(b"\n")
+        last = buf[-1:]
+    if last != b"\n":
+        for dst in dsts:
+            dst.write(b"\n")
+        num_lines += 1
+    return num_lines
+
+
+def _merge_patch_group(key, files, merged_dir):
+    """Merge the patch files of one group into merged_dir/key.csv and return the number of rows."""
+    num_picks = 0
+    header = None
+    merged_file = merged_dir / f"{key}.csv"
+    merged_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(merged_file, "wb") as fp_file:
+        for file in sorted(files):
+            with open(file, "rb") as f:
+                line = f.readline()
+                if len(line) == 0:
+                    continue
+                if header is None:
+                    header = line
+                    fp_file.write(header)
+                num_picks += _copy_lines(f, [fp_file])
+    return num_picks
+
+
+def merge_patch(patch_dir, merged_dir, return_single_file=False, num_workers=None):
     patch_dir = Path(patch_dir)
     merged_dir = Path(merged_dir)
     if not merged_dir.exists():
@@ -359,30 +495,30 @@ def merge_patch(patch_dir, merged_dir, return_single_file=False):
         key = "_".join((str(file).replace(f"{patch_dir}/", "")).split("_")[:-2])
         group[key].append(file)  ## event_id
 
-    if return_single_file:
-        fp_total = open(str(merged_dir).rstrip("/") + ".csv", "w")
+    ## groups are independent and I/O bound, so merge them in a thread pool
+    if num_workers is None:
+        num_workers = min(32, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        num_picks = sum(
+            tqdm(
+                executor.map(partial(_merge_patch_group, merged_dir=merged_dir), group.keys(), group.values()),
+                total=len(group),
+                desc=f"Merging {merged_dir}",
+            )
+        )
 
-    num_picks = 0
-    header0 = None
-    for k in tqdm(group, desc=f"Merging {merged_dir}"):
-        header = None
-        if not (merged_dir / f"{k}.csv").parent.exists():
-            (merged_dir / f"{k}.csv").parent.mkdir()
-        with open(merged_dir / f"{k}.csv", "w") as fp_file:
-            for file in sorted(group[k]):
-                with open(file, "r") as f:
-                    lines = f.readlines()
-                    if len(lines) > 0:
-                        if header is None:
-                            header = lines[0]
-                            fp_file.writelines(header)
-                        if return_single_file and (header0 is None):
-                            header = lines[0]
-                            fp_total.writelines(header)
-                        fp_file.writelines(lines[1:])
-                        if return_single_file:
-                            fp_total.writelines(lines[1:])
-                        num_picks += len(lines[1:])
+    if return_single_file:
+        header0 = None
+        with open(str(merged_dir).rstrip("/") + ".csv", "wb") as fp_total:
+            for k in group:
+                with open(merged_dir / f"{k}.csv", "rb") as f:
+                    line = f.readline()
+                    if len(line) == 0:
+                        continue
+                    if header0 is None:
+                        header0 = line
+                        fp_total.write(header0)
+                    _copy_lines(f, [fp_total])
 
     print(f"Number of detections: {num_picks}")
     return 0
@@ -113,4 +113,18 @@ def cut_reorder_keys(example, num_stations_list=[5, 10, 20]):
         example["event_location"] = example["event_location"][cut,:,:].permute(1,2,0).contiguous()
         example["event_location_mask"] = example["event_location_mask"][cut,:].permute(1,0).contiguous()
         example["station_location"] = example["station_location"][cut,:].contiguous()
-        return example
\ No newline at end of file
+        return example
+
+
+def cut_reorder_keys_batched(examples, num_stations_list=[5, 10, 20]):
+    '''
+    batched version of cut_reorder_keys for datasets.map(batched=True), which writes one arrow batch per call
+    instead of one per example; events have different numbers of stations, so the rows are still cut one by one
+    '''
+    keys = list(examples.keys())
+    batched = {key: [] for key in keys}
+    for i in range(len(examples["station_location"])):
+        example = cut_reorder_keys({key: examples[key][i] for key in keys}, num_stations_list=num_stations_list)
+        for key in keys:
+            batched[key].append(example[key])
+    return batched
@@ -20,7 +20,7 @@ def normalize(x):
 
 def plot_autoencoder_das_train(meta, preds, epoch, figure_dir="figures"):
     meta_data = meta["data"]
-    raw_data = meta_data.clone().permute(0, 2, 3, 1).numpy()
+    raw_data = meta_data.permute(0, 2, 3, 1).numpy()
     # data = normalize_local(meta_data.clone()).permute(0, 2, 3, 1).numpy()
     targets = meta["targets"].permute(0, 2, 3, 1).numpy()
 
@@ -63,7 +63,7 @@ def plot_autoencoder_das_train(meta, preds, epoch, figure_dir="figures"):
 
 def plot_das_train(meta, preds, epoch, figure_dir="figures", dt=0.01, dx=10, prefix=""):
     meta_data = meta["data"].cpu()
-    raw_data = meta_data.clone().permute(0, 2, 3, 1).numpy()
+    raw_data = meta_data.permute(0, 2, 3, 1).numpy()
     # data = normalize_local(meta_data.clone()).permute(0, 2, 3, 1).numpy()
     targets = meta["phase_pick"].permute(0, 2, 3, 1).numpy()
     y = preds.permute(0, 2, 3, 1).numpy()
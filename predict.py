@@ -1,29 +1,38 @@
+import csv
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
 from glob import glob
+from operator import itemgetter
 
 import eqnet
 import matplotlib
 import pandas as pd
 import torch
 import torch.multiprocessing as mp
+import torch.nn.functional as F
 import torch.utils.data
 import utils
 import wandb
 from eqnet.data import DASIterableDataset, SeismicTraceIterableDataset
 from eqnet.models.unet import moving_normalize
 from eqnet.utils import (
+    dequantize_scores,
     detect_peaks,
     extract_events,
     extract_picks,
+    find_peaks,
     merge_events,
     merge_patch,
     merge_picks,
     plot_das,
     plot_phasenet,
     plot_phasenet_plus,
+    quantize_scores,
+    to_host,
+    to_host_async,
 )
 from tqdm import tqdm
 
@@ -48,25 +57,131 @@ def postprocess(meta, output, polarity_scale=1, event_scale=16):
     return meta, output
 
 
+def write_csv(file, rows, columns=None, sort_by=None):
+    ## write a list of dicts with the csv module; much cheaper than a DataFrame + to_csv per file
+    if sort_by is not None:
+        rows = sorted(rows, key=itemgetter(*sort_by))
+    if columns is None:
+        columns = list(rows[0].keys())
+    with open(file, "w", newline="", buffering=1 << 20) as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns, extrasaction="ignore", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_parquet(file, rows, columns=None, sort_by=None):
+    ## needs pyarrow (or fastparquet); no text formatting and a much smaller file than csv
+    if sort_by is not None:
+        rows = sorted(rows, key=itemgetter(*sort_by))
+    pd.DataFrame(rows, columns=columns).to_parquet(file, index=False)
+
+
+def pick_writer(args):
+    writer = {"csv": write_csv, "parquet": write_parquet}[args.pick_format]
+    return writer, f".{args.pick_format}"
+
+
+def output_file(root, parent_dir, filename, made_dirs):
+    ## create each output directory once per run instead of probing the filesystem for every file
+    dirname = os.path.join(root, parent_dir)
+    if dirname not in made_dirs:
+        os.makedirs(dirname, exist_ok=True)
+        made_dirs.add(dirname)
+    return os.path.join(dirname, filename)
+
+
+def model_inputs(meta, args):
+    ## copy the (pinned) input to the device asynchronously; when the model runs in half precision
+    ## (see main), cast it on the way instead of using autocast. meta["data"] stays on the host.
+    data = meta["data"].to(args.device, dtype=args.model_dtype, non_blocking=True)
+    if args.channels_last:
+        data = data.contiguous(memory_format=torch.channels_last)
+    return {**meta, "data": data}
+
+
+class CUDAGraphModel:
+    """Replay a CUDA graph of the forward pass for the fixed input shape of --cut_patch; other shapes run eagerly."""
+
+    def __init__(self, model, warmup=3):
+        self.model = model
+        self.warmup = warmup
+        self.graph = None
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def capture(self, data):
+        self.static_data = data.clone()
+        ## warm up on a side stream (cudnn autotuning, lazy allocations) before capturing
+        stream = torch.cuda.Stream(device=data.device)
+        stream.wait_stream(torch.cuda.current_stream(data.device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup):
+                self.model({"data": self.static_data})
+        torch.cuda.current_stream(data.device).wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_output = self.model({"data": self.static_data})
+
+    def __call__(self, inputs):
+        data = inputs["data"]
+        if self.graph is None:
+            self.capture(data)
+        if (data.shape != self.static_data.shape) or (data.dtype != self.static_data.dtype):
+            return self.model(inputs)
+        self.static_data.copy_(data, non_blocking=True)
+        self.graph.replay()
+        ## the outputs are overwritten by the next replay; they are consumed before the next batch
+        return dict(self.static_output)
+
+
+def autocast_context(args):
+    if (args.device in ["cpu", "mps"]) or (args.model_dtype is not None):
+        return nullcontext()
+    ## a CUDA graph captured with the autocast weight cache would replay reads of the cached casts, which are freed
+    ## when the autocast context exits
+    return torch.amp.autocast(device_type=args.device, dtype=args.ptdtype, cache_enabled=(not args.cuda_graph))
+
+
+def softmax_peaks(logits, vmin, kernel, dt=0.01):
+    return find_peaks(torch.softmax(logits.float(), dim=1), vmin=vmin, kernel=kernel, dt=dt)
+
+
+def peak_finder(args):
+    ## with --compile_postprocess the softmax, max-pooling and masking passes over the score volume are fused
+    if args.compile_postprocess:
+        return torch.compile(softmax_peaks, dynamic=True)
+    return softmax_peaks
+
+
+@torch.inference_mode()
 def pred_phasenet(args, model, data_loader, pick_path, figure_path):
     model.eval()
-    ctx = nullcontext() if args.device == "cpu" else torch.amp.autocast(device_type=args.device, dtype=args.ptdtype)
-    with torch.inference_mode():
+    ctx = autocast_context(args)
+    phase_peaks = peak_finder(args)
+    write_picks, suffix = pick_writer(args)
+    made_dirs = set()
+    default_dt = torch.tensor(0.01)
+    ## CSV files are written in a background thread pool so the next batch can start on the GPU
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.io_workers) as io_pool:
         for meta in tqdm(data_loader, desc="Predicting", total=len(data_loader)):
             with ctx:
-                output = model(meta)
+                output = model(model_inputs(meta, args))
                 meta, output = postprocess(meta, output)
             if "phase" in output:
-                phase_scores = torch.softmax(output["phase"], dim=1)  # [batch, nch, nt, nsta]
-                topk_phase_scores, topk_phase_inds = detect_peaks(phase_scores, vmin=args.min_prob, kernel=128)
+                topk_phase_scores, topk_phase_inds = to_host(
+                    *phase_peaks(output["phase"], vmin=args.min_prob, kernel=128)
+                )  # [batch, nch, nsta, k]
                 phase_picks_ = extract_picks(
                     topk_phase_inds,
                     topk_phase_scores,
                     file_name=meta["file_name"],
                     station_id=meta["station_id"],
-                    begin_time=meta["begin_time"] if "begin_time" in meta else None,
-                    begin_time_index=meta["begin_time_index"] if "begin_time_index" in meta else None,
-                    dt=meta["dt_s"] if "dt_s" in meta else 0.01,
+                    begin_time=meta.get("begin_time"),
+                    begin_time_index=meta.get("begin_time_index"),
+                    dt=meta.get("dt_s", 0.01),
                     vmin=args.min_prob,
                     phases=args.phases,
                     waveform=meta["data"],
@@ -78,68 +193,88 @@ def pred_phasenet(args, model, data_loader, pick_path, figure_path):
                 parent_dir = "/".join(tmp[-args.subdir_level - 1 : -1])
                 filename = tmp[-1].replace("*", "").replace("?", "").replace(".mseed", "")
 
-                if not os.path.exists(os.path.join(pick_path, parent_dir)):
-                    os.makedirs(os.path.join(pick_path, parent_dir), exist_ok=True)
+                pick_file = output_file(pick_path, parent_dir, filename + suffix, made_dirs)
                 if len(phase_picks_[i]) == 0:
                     ## keep an empty file for the file with no picks to make it easier to track processed files
-                    with open(os.path.join(pick_path, parent_dir, filename + ".csv"), "a"):
+                    with open(pick_file, "a"):
                         pass
                     continue
-                picks_df = pd.DataFrame(phase_picks_[i])
-                picks_df.sort_values(by=["phase_time"], inplace=True)
-                picks_df.to_csv(os.path.join(pick_path, parent_dir, filename + ".csv"), index=False)
+                futures.append(io_pool.submit(write_picks, pick_file, phase_picks_[i], sort_by=["phase_time"]))
 
             if args.plot_figure:
-                # meta["waveform_raw"] = meta["waveform"].clone()
                 # meta["data"] = moving_normalize(meta["data"])
+                phase_scores = torch.softmax(output["phase"].float(), dim=1)  # [batch, nch, nt, nsta]
                 plot_phasenet(
                     meta,
-                    phase_scores.cpu(),
+                    dequantize_scores(to_host(quantize_scores(phase_scores))[0]),
                     file_name=meta["file_name"],
-                    dt=meta["dt_s"] if "dt_s" in meta else torch.tensor(0.01),
+                    dt=meta.get("dt_s", default_dt),
                     figure_dir=figure_path,
                 )
 
+    for future in futures:
+        future.result()
+
     ## merge picks
     if args.distributed:
-        torch.distributed.barrier()
+        utils.barrier(args)
         if utils.is_main_process():
-            merge_picks(pick_path)
+            merge_picks(pick_path, format=args.pick_format)
     else:
-        merge_picks(pick_path)
+        merge_picks(pick_path, format=args.pick_format)
     return 0
 
 
+@torch.inference_mode()
 def pred_phasenet_plus(args, model, data_loader, pick_path, event_path, figure_path):
     model.eval()
-    ctx = (
-        nullcontext()
-        if args.device in ["cpu", "mps"]
-        else torch.amp.autocast(device_type=args.device, dtype=args.ptdtype)
-    )
-    with torch.inference_mode():
+    ctx = autocast_context(args)
+    phase_peaks = peak_finder(args)
+    write_picks, suffix = pick_writer(args)
+    made_dirs = set()
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.io_workers) as io_pool:
         for meta in tqdm(data_loader, desc="Predicting", total=len(data_loader)):
             with ctx:
-                output = model(meta)
+                output = model(model_inputs(meta, args))
                 meta, output = postprocess(meta, output)
 
-            dt = meta["dt_s"] if "dt_s" in meta else [torch.tensor(0.01)] * len(meta["data"])
+            dt = meta.get("dt_s")
+            if dt is None:
+                dt = torch.full((len(meta["data"]),), 0.01)
 
+            ## the phase peaks are copied to the host while the event peaks are found on the GPU
             if "phase" in output:
-                phase_scores = torch.softmax(output["phase"], dim=1)  # [batch, nch, nt, nsta]
                 if "polarity" in output:
                     # polarity_scores = torch.sigmoid(output["polarity"])
-                    polarity_scores = torch.softmax(output["polarity"], dim=1)
-                topk_phase_scores, topk_phase_inds = detect_peaks(
-                    phase_scores, vmin=args.min_prob, kernel=128, dt=dt.min().item()
+                    polarity_scores = torch.softmax(output["polarity"].float(), dim=1)
+                (topk_phase_scores, topk_phase_inds), phase_peaks_copied = to_host_async(
+                    *phase_peaks(output["phase"], vmin=args.min_prob, kernel=128, dt=dt.min().item())
+                )
+
+            if ("event_center" in output) and (output["event_center"] is not None):
+                event_time = output["event_time"].float()
+                ## sigmoid is monotonic, so find the peaks on the logits and only apply it to the top-k values
+                topk_event_logits, topk_event_inds = find_peaks(
+                    output["event_center"].float(),
+                    vmin=args.min_prob,
+                    kernel=16,
+                    dt=dt.min().item() * 16.0,
+                    fill_value=float("-inf"),
                 )
+                (topk_event_scores, topk_event_inds), event_peaks_copied = to_host_async(
+                    torch.sigmoid(topk_event_logits), topk_event_inds
+                )
+
+            if "phase" in output:
+                phase_peaks_copied()
                 phase_picks = extract_picks(
                     topk_phase_inds,
                     topk_phase_scores,
                     file_name=meta["file_name"],
                     station_id=meta["station_id"],
-                    begin_time=meta["begin_time"] if "begin_time" in meta else None,
-                    begin_time_index=meta["begin_time_index"] if "begin_time_index" in meta else None,
+                    begin_time=meta.get("begin_time"),
+                    begin_time_index=meta.get("begin_time_index"),
                     dt=dt,
                     vmin=args.min_prob,
                     phases=args.phases,
@@ -148,18 +283,14 @@ def pred_phasenet_plus(args, model, data_loader, pick_path, event_path, figure_p
                 )
 
             if ("event_center" in output) and (output["event_center"] is not None):
-                event_center = torch.sigmoid(output["event_center"])
-                event_time = output["event_time"]
-                topk_event_scores, topk_event_inds = detect_peaks(
-                    event_center, vmin=args.min_prob, kernel=16, dt=dt.min().item() * 16.0
-                )
+                event_peaks_copied()
                 event_detects = extract_events(
                     topk_event_inds,
                     topk_event_scores,
                     file_name=meta["file_name"],
                     station_id=meta["station_id"],
-                    begin_time=meta["begin_time"] if "begin_time" in meta else None,
-                    begin_time_index=meta["begin_time_index"] if "begin_time_index" in meta else None,
+                    begin_time=meta.get("begin_time"),
+                    begin_time_index=meta.get("begin_time_index"),
                     dt=dt,
                     vmin=args.min_prob,
                     event_time=event_time,
@@ -171,35 +302,38 @@ def pred_phasenet_plus(args, model, data_loader, pick_path, event_path, figure_p
                 parent_dir = "/".join(tmp[-args.subdir_level - 1 : -1])
                 filename = tmp[-1].replace("*", "").replace("?", "").replace(".mseed", "")
 
-                if not os.path.exists(os.path.join(pick_path, parent_dir)):
-                    os.makedirs(os.path.join(pick_path, parent_dir), exist_ok=True)
+                pick_file = output_file(pick_path, parent_dir, filename + suffix, made_dirs)
                 if len(phase_picks[i]) == 0:
                     ## keep an empty file for the file with no picks to make it easier to track processed files
-                    with open(os.path.join(pick_path, parent_dir, filename + ".csv"), "a"):
+                    with open(pick_file, "a"):
                         pass
                     continue
-                picks_df = pd.DataFrame(phase_picks[i])
-                picks_df.sort_values(by=["phase_time"], inplace=True)
-                picks_df.to_csv(os.path.join(pick_path, parent_dir, filename + ".csv"), index=False)
+                futures.append(io_pool.submit(write_picks, pick_file, phase_picks[i], sort_by=["phase_time"]))
 
                 if ("event_center" in output) and ("event_time" in output):
-                    if not os.path.exists(os.path.join(event_path, parent_dir)):
-                        os.makedirs(os.path.join(event_path, parent_dir), exist_ok=True)
+                    event_file = output_file(event_path, parent_dir, filename + suffix, made_dirs)
                     if len(event_detects[i]) == 0:
-                        with open(os.path.join(event_path, parent_dir, filename + ".csv"), "a"):
+                        with open(event_file, "a"):
                             pass
                         continue
-                    events_df = pd.DataFrame(event_detects[i])
-                    events_df.sort_values(by=["event_time"], inplace=True)
-                    events_df.to_csv(os.path.join(event_path, parent_dir, filename + ".csv"), index=False)
+                    futures.append(io_pool.submit(write_picks, event_file, event_detects[i], sort_by=["event_time"]))
 
             if args.plot_figure:
+                ## one batched device-to-host copy instead of a synchronous .cpu() per tensor
+                phase_scores_, polarity_scores_, event_center_, event_time_ = to_host(
+                    quantize_scores(torch.softmax(output["phase"].float(), dim=1)),
+                    quantize_scores(polarity_scores),
+                    quantize_scores(
+                        torch.sigmoid(output["event_center"].float()) if "event_center" in output else None
+                    ),
+                    event_time if "event_time" in output else None,
+                )
                 plot_phasenet_plus(
                     meta,
-                    phase_scores.cpu().float(),
-                    polarity_scores.cpu().float() if polarity_scores is not None else None,
-                    event_center.cpu().float() if "event_center" in output else None,
-                    event_time.cpu().float() if "event_time" in output else None,
+                    dequantize_scores(phase_scores_),
+                    dequantize_scores(polarity_scores_),
+                    dequantize_scores(event_center_),
+                    event_time_,
                     phase_picks=phase_picks,
                     event_detects=event_detects,
                     file_name=meta["file_name"],
@@ -207,39 +341,47 @@ def pred_phasenet_plus(args, model, data_loader, pick_path, event_path, figure_p
                     figure_dir=figure_path,
                 )
 
+    for future in futures:
+        future.result()
+
     ## merge picks
     if args.distributed:
-        torch.distributed.barrier()
+        utils.barrier(args)
         if utils.is_main_process():
-            merge_picks(pick_path)
-            merge_events(event_path)
+            merge_picks(pick_path, format=args.pick_format)
+            merge_events(event_path, format=args.pick_format)
     else:
-        merge_picks(pick_path)
-        merge_events(event_path)
+        merge_picks(pick_path, format=args.pick_format)
+        merge_events(event_path, format=args.pick_format)
     return 0
 
 
+@torch.inference_mode()
 def pred_phasenet_das(args, model, data_loader, pick_path, figure_path):
     model.eval()
-    ctx = nullcontext() if args.device == "cpu" else torch.amp.autocast(device_type=args.device, dtype=args.ptdtype)
-    with torch.inference_mode():
+    ctx = autocast_context(args)
+    phase_peaks = peak_finder(args)
+    write_picks, suffix = pick_writer(args)
+    made_dirs = set()
+    default_dt, default_dx = torch.tensor(0.01), torch.tensor(10.0)
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.io_workers) as io_pool:
         # for meta in metric_logger.log_every(data_loader, 1, header):
         for meta in tqdm(data_loader, desc="Predicting", total=len(data_loader)):
             with ctx:
-                output = model(meta)
+                output = model(model_inputs(meta, args))
 
             meta, output = postprocess(meta, output)
-            scores = torch.softmax(output["phase"], dim=1)  # [batch, nch, nt, nsta]
-            topk_scores, topk_inds = detect_peaks(scores, vmin=args.min_prob, kernel=21)
+            topk_scores, topk_inds = to_host(*phase_peaks(output["phase"], vmin=args.min_prob, kernel=21))
 
             picks_ = extract_picks(
                 topk_inds,
                 topk_scores,
                 file_name=meta["file_name"],
-                begin_time=meta["begin_time"] if "begin_time" in meta else None,
-                begin_time_index=meta["begin_time_index"] if "begin_time_index" in meta else None,
-                begin_channel_index=meta["begin_channel_index"] if "begin_channel_index" in meta else None,
-                dt=meta["dt_s"] if "dt_s" in meta else 0.01,
+                begin_time=meta.get("begin_time"),
+                begin_time_index=meta.get("begin_time_index"),
+                begin_channel_index=meta.get("begin_channel_index"),
+                dt=meta.get("dt_s", 0.01),
                 vmin=args.min_prob,
                 phases=args.phases,
             )
@@ -248,39 +390,45 @@ def pred_phasenet_das(args, model, data_loader, pick_path, figure_path):
                 tmp = meta["file_name"][i].split("/")
                 parent_dir = "/".join(tmp[-args.subdir_level - 1 : -1])
                 filename = tmp[-1].replace("*", "").replace(f".{args.format}", "")
-                if not os.path.exists(os.path.join(pick_path, parent_dir)):
-                    os.makedirs(os.path.join(pick_path, parent_dir), exist_ok=True)
+                pick_file = output_file(pick_path, parent_dir, filename + suffix, made_dirs)
 
                 if len(picks_[i]) == 0:
                     ## keep an empty file for the file with no picks to make it easier to track processed files
-                    with open(os.path.join(pick_path, parent_dir, filename + ".csv"), "a"):
+                    with open(pick_file, "a"):
                         pass
                     continue
-                picks_df = pd.DataFrame(picks_[i])
-                picks_df["channel_index"] = picks_df["station_id"].apply(lambda x: int(x))
-                picks_df.sort_values(by=["channel_index", "phase_index"], inplace=True)
-                picks_df.to_csv(
-                    os.path.join(pick_path, parent_dir, filename + ".csv"),
-                    columns=["channel_index", "phase_index", "phase_time", "phase_score", "phase_type"],
-                    index=False,
+                futures.append(
+                    io_pool.submit(
+                        write_picks,
+                        pick_file,
+                        picks_[i],
+                        columns=["channel_index", "phase_index", "phase_time", "phase_score", "phase_type"],
+                        sort_by=["channel_index", "phase_index"],
+                    )
                 )
 
             if args.plot_figure:
+                ## the image has far fewer pixel rows than time samples; max pooling keeps the narrow peaks visible
+                plot_scores = torch.softmax(output["phase"].float(), dim=1)
+                plot_scores = F.max_pool2d(plot_scores, (args.plot_downsample, 1), ceil_mode=True)
                 plot_das(
-                    meta["data"].cpu().float(),
-                    scores.cpu().float(),
+                    meta["data"].float(),
+                    dequantize_scores(to_host(quantize_scores(plot_scores))[0]),
                     picks=picks_,
                     phases=args.phases,
                     file_name=meta["file_name"],
-                    begin_time_index=meta["begin_time_index"] if "begin_time_index" in meta else None,
-                    begin_channel_index=meta["begin_channel_index"] if "begin_channel_index" in meta else None,
-                    dt=meta["dt_s"] if "dt_s" in meta else torch.tensor(0.01),
-                    dx=meta["dx_m"] if "dx_m" in meta else torch.tensor(10.0),
+                    begin_time_index=meta.get("begin_time_index"),
+                    begin_channel_index=meta.get("begin_channel_index"),
+                    dt=meta.get("dt_s", default_dt),
+                    dx=meta.get("dx_m", default_dx),
                     figure_dir=figure_path,
                 )
 
+    for future in futures:
+        future.result()
+
     if args.distributed:
-        torch.distributed.barrier()
+        utils.barrier(args)
         if args.cut_patch and utils.is_main_process():
             merge_patch(pick_path, pick_path.rstrip("_patch"), return_single_file=False)
     else:
@@ -300,18 +448,19 @@ def main(args):
         pick_path = os.path.join(result_path, f"picks_{args.model}")
         event_path = os.path.join(result_path, f"events_{args.model}")
         figure_path = os.path.join(result_path, f"figures_{args.model}")
-    if not os.path.exists(result_path):
-        utils.mkdir(result_path)
-    if not os.path.exists(pick_path):
-        utils.mkdir(pick_path)
-    if not os.path.exists(event_path):
-        utils.mkdir(event_path)
-    if not os.path.exists(figure_path):
-        utils.mkdir(figure_path)
+
+    if args.cut_patch and (args.model == "phasenet_das") and (args.pick_format != "csv"):
+        raise ValueError("merging DAS patches only supports --pick_format csv")
 
     utils.init_distributed_mode(args)
     print(args)
 
+    ## create the output directories once on the main rank instead of probing them from every rank
+    if utils.is_main_process():
+        for path in [result_path, pick_path, event_path, figure_path]:
+            os.makedirs(path, exist_ok=True)
+    utils.barrier(args)
+
     if args.distributed:
         rank = utils.get_rank()
         world_size = utils.get_world_size()
@@ -333,7 +482,8 @@ def main(args):
         torch.backends.cudnn.benchmark = False
         torch.use_deterministic_algorithms(True)
     else:
-        torch.backends.cudnn.benchmark = True
+        ## autotuning pays off only when every batch has the same shape, which --cut_patch guarantees
+        torch.backends.cudnn.benchmark = args.cut_patch if args.cudnn_benchmark is None else args.cudnn_benchmark
 
     if args.model in ["phasenet", "phasenet_plus"]:
         dataset = SeismicTraceIterableDataset(
@@ -387,6 +537,9 @@ def main(args):
         num_workers=min(args.workers, mp.cpu_count()),
         collate_fn=None,
         drop_last=False,
+        pin_memory=(device.type == "cuda"),
+        persistent_workers=(args.workers > 0),
+        prefetch_factor=(args.prefetch_factor if args.workers > 0 else None),
     )
 
     model = eqnet.models.__dict__[args.model].build_model(
@@ -397,6 +550,15 @@ def main(args):
     logger.info("Model:\n{}".format(model))
 
     model.to(device)
+    ## inference only: run the model itself in half precision instead of paying autocast dispatch per op
+    args.model_dtype = None
+    if args.amp and (device.type == "cuda"):
+        model = model.to(ptdtype)
+        args.model_dtype = ptdtype
+    ## cuDNN picks faster NHWC convolution kernels and skips internal layout conversions
+    args.channels_last = device.type == "cuda"
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
     if args.distributed:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
@@ -439,11 +601,17 @@ def main(args):
 
     model_without_ddp = model
     if args.distributed:
-        torch.distributed.barrier()
+        utils.barrier(args)
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
         model_without_ddp = model.module
     model_without_ddp.load_state_dict(checkpoint["model"], strict=True)
 
+    if args.cuda_graph:
+        if args.cut_patch and (device.type == "cuda") and (not args.distributed):
+            model = CUDAGraphModel(model)
+        else:
+            logger.warning("--cuda_graph needs --cut_patch on a single GPU; running eagerly")
+
     if args.model == "phasenet":
         pred_phasenet(args, model, data_loader, pick_path, figure_path)
 
@@ -467,8 +635,18 @@ def get_args_parser(add_help=True):
 
     parser.add_argument("--device", default="cuda", type=str, help="device (Use cuda or cpu Default: cuda)")
     parser.add_argument(
-        "-j", "--workers", default=0, type=int, metavar="N", help="number of data loading workers (default: 16)"
+        "-j",
+        "--workers",
+        default=0,
+        type=int,
+        metavar="N",
+        help="number of data loading workers (default: 0); raise it until the GPU no longer waits on reading files",
+    )
+    parser.add_argument("--prefetch_factor", default=4, type=int, help="batches loaded in advance by each worker")
+    parser.add_argument(
+        "--pick_format", default="csv", choices=["csv", "parquet"], help="file format of picks (parquet needs pyarrow)"
     )
+    parser.add_argument("--io_workers", default=4, type=int, help="number of threads writing pick files")
     parser.add_argument(
         "-b", "--batch_size", default=1, type=int, help="images per gpu, the total batch size is $NGPU x batch_size"
     )
@@ -476,7 +654,9 @@ def get_args_parser(add_help=True):
     parser.add_argument(
         "--use_deterministic_algorithms", action="store_true", help="Forces the use of deterministic algorithms only."
     )
-    parser.add_argument("--amp", action="store_true", help="Use torch.cuda.amp for mixed precision training")
+    parser.add_argument(
+        "--amp", action="store_true", help="Run the model in bfloat16/float16 on GPU instead of autocast"
+    )
 
     # distributed training parameters
     parser.add_argument("--world-size", default=1, type=int, help="number of distributed processes")
@@ -490,6 +670,21 @@ def get_args_parser(add_help=True):
     parser.add_argument("--format", type=str, default="h5", help="data format")
     parser.add_argument("--dataset", type=str, default="das", help="dataset type; seismic_trace, seismic_network, das")
     parser.add_argument("--result_path", type=str, default="results", help="path to result directory")
+    parser.add_argument(
+        "--cuda_graph", action="store_true", help="Replay the forward pass as a CUDA graph (requires --cut_patch)"
+    )
+    parser.add_argument(
+        "--compile_postprocess", action="store_true", help="torch.compile the softmax and peak detection"
+    )
+    parser.add_argument(
+        "--plot_downsample", default=4, type=int, help="time downsampling of the DAS score image in figures"
+    )
+    parser.add_argument(
+        "--cudnn_benchmark",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="cuDNN autotuning (default: on with --cut_patch, off for variable-length inputs)",
+    )
     parser.add_argument("--plot_figure", action="store_true", help="If plot figure for test")
     parser.add_argument("--min_prob", default=0.3, type=float, help="minimum probability for picking")
 
@@ -18,11 +18,25 @@ def read_labels(file):
         event_ids = list(fp.keys())
         for event_id in tqdm(event_ids):
             event_attrs = dict(fp[event_id].attrs)
-            station_ids = list(fp[event_id].keys())
+            if "stations" in fp[event_id]:
+                ## newer files keep the station metadata in one table per event instead of per-trace attributes
+                table = fp[event_id]["stations"][:]
+                station_ids = [x.decode() for x in table["station_id"]]
+                stations = {
+                    station_id: {
+                        "phase_time": row["phase_time"].astype(str),
+                        "phase_type": np.array(["P", "S"]),
+                        "phase_polarity": row["phase_polarity"].astype(str),
+                    }
+                    for station_id, row in zip(station_ids, table)
+                }
+            else:
+                station_ids = list(fp[event_id].keys())
+                stations = {station_id: fp[event_id][station_id].attrs for station_id in station_ids}
             # for station_id in station_ids:
             #     label.append(fp[event_id][station_id]["label"][()])
             for station_id in station_ids:
-                station_attrs = dict(fp[event_id][station_id].attrs)
+                station_attrs = dict(stations[station_id])
                 num_picks = len(station_attrs["phase_time"])
                 labels = {
                     "event_index": [event_id] * num_picks,
@@ -1,11 +1,39 @@
+import argparse
 import datetime
 import logging
 import os
 import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
 from glob import glob
 
+
+def add_workers_argument(parser):
+    parser.add_argument(
+        "-j",
+        "--workers",
+        default=4,
+        type=int,
+        metavar="N",
+        help="number of data loading workers (default: 16)",
+    )
+
+
+def num_cpu_threads(workers):
+    ## share the node's cores between its ranks and their loader workers instead of each starting os.cpu_count() threads
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    return max(1, (os.cpu_count() or 1) // (local_world_size * max(1, workers)))
+
+
+if __name__ == "__main__":
+    ## the BLAS/OpenMP pools read these once, so set them before numpy and torch are imported
+    workers_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    add_workers_argument(workers_parser)
+    num_threads = str(num_cpu_threads(workers_parser.parse_known_args()[0].workers))
+    for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ.setdefault(name, num_threads)
+
 import matplotlib
 import numpy as np
 import torch
@@ -22,17 +50,134 @@ from eqnet.data import (
     AutoEncoderIterableDataset,
     DASIterableDataset,
     SeismicNetworkIterableDataset,
-    SeismicTraceIterableDataset,
+    SeismicTraceDataset,
+    collate_batch,
 )
 from eqnet.models.unet import moving_normalize
-from eqnet.utils.station_sampler import StationSampler, create_groups, cut_reorder_keys
+from eqnet.utils.station_sampler import StationSampler, create_groups, cut_reorder_keys_batched
 
 matplotlib.use("agg")
 logger = logging.getLogger("EQNet")
 # mp.set_start_method("spawn", force=True)
 
 
-def evaluate(model, data_loader, scaler, args, epoch=0, total_samples=1):
+def model_inputs(meta, args):
+    ## copy the batch to the device asynchronously (a no-op for prefetched batches); NHWC lets cuDNN use
+    ## tensor-core convolutions without transposing around every conv
+    inputs = {k: (v.to(args.device, non_blocking=True) if torch.is_tensor(v) else v) for k, v in meta.items()}
+    if args.channels_last and (inputs["data"].dim() == 4):
+        inputs["data"] = inputs["data"].contiguous(memory_format=torch.channels_last)
+    return inputs
+
+
+class GraphedStep(nn.Module):
+    """Tensor-only view of a model taking and returning dicts, so its forward and backward can be CUDA-graphed."""
+
+    def __init__(self, model, input_keys, output_keys):
+        super().__init__()
+        self.model = model
+        self.input_keys = input_keys
+        self.output_keys = output_keys
+
+    def forward(self, *inputs):
+        output = self.model(dict(zip(self.input_keys, inputs)))
+        return tuple(output[key] for key in self.output_keys)
+
+
+def make_graphed_model(model, meta, args):
+    ## replay forward and backward as CUDA graphs for fixed-shape batches; the optimizer step stays eager
+    inputs = model_inputs(meta, args)
+    input_keys = [key for key, value in inputs.items() if torch.is_tensor(value)]
+    sample_inputs = tuple(inputs[key] for key in input_keys)
+    with torch.amp.autocast(device_type=args.device, dtype=args.ptdtype, cache_enabled=False):
+        output = model(inputs)
+    output_keys = [key for key, value in output.items() if torch.is_tensor(value)]
+    del output
+    with torch.amp.autocast(device_type=args.device, dtype=args.ptdtype, cache_enabled=False):
+        graphed = torch.cuda.make_graphed_callables(GraphedStep(model, input_keys, output_keys), sample_inputs)
+
+    def forward(meta):
+        inputs = model_inputs(meta, args)
+        return dict(zip(output_keys, graphed(*[inputs[key] for key in input_keys])))
+
+    return forward
+
+
+def overlap_optimizer(model, optimizer):
+    ## step each parameter inside DDP's comm hook as soon as its gradient bucket is all-reduced;
+    ## the returned functional optimizer only follows the scheduler through its "lr" default
+    from torch.distributed.algorithms._optimizer_overlap import _as_overlapped_optim
+
+    group = optimizer.param_groups[0]
+    if isinstance(optimizer, torch.optim.SGD):
+        kwargs = dict(momentum=group["momentum"], nesterov=group["nesterov"])
+    else:
+        kwargs = dict(betas=group["betas"], eps=group["eps"])
+    overlapped = _as_overlapped_optim(
+        type(optimizer), group["params"], lr=group["lr"], weight_decay=group["weight_decay"], **kwargs
+    )
+    overlapped.register_ddp(model)
+    return overlapped._opt_hook_state.functional_optimizer
+
+
+def optimizer_state_dict(optimizer, overlapped_optimizer=None):
+    ## with --overlap-optim the eager optimizer is never stepped, so its state dict carries the functional state;
+    ## the layout is the eager one, so such checkpoints also resume without --overlap-optim
+    state_dict = optimizer.state_dict()
+    if overlapped_optimizer is not None:
+        params = optimizer.param_groups[0]["params"]
+        state = overlapped_optimizer.state
+        state_dict["state"] = {i: state[p] for i, p in enumerate(params) if p in state}
+    return state_dict
+
+
+def load_optimizer_state_dict(optimizer, state_dict, overlapped_optimizer=None):
+    optimizer.load_state_dict(state_dict)
+    if overlapped_optimizer is not None:
+        for p in optimizer.param_groups[0]["params"]:
+            if p in optimizer.state:
+                ## the functional step keeps its step counter on the host
+                state = dict(optimizer.state.pop(p))
+                if torch.is_tensor(state.get("step")):
+                    state["step"] = state["step"].cpu()
+                overlapped_optimizer.state[p] = state
+
+
+def lr_schedule(args, iters_per_epoch):
+    ## the learning rate of every training step, computed once in closed form instead of by a scheduler each step
+    warmup_iters = args.lr_warmup_epochs * iters_per_epoch
+    main_iters = (args.epochs - args.lr_warmup_epochs) * iters_per_epoch
+    step = np.arange(args.epochs * iters_per_epoch + 1, dtype=np.float64)
+    main_step = np.maximum(step - warmup_iters, 0)
+
+    args.lr_scheduler = args.lr_scheduler.lower()
+    if args.lr_scheduler == "steplr":
+        lrs = args.lr * args.lr_gamma ** (main_step // (args.lr_step_size * iters_per_epoch))
+    elif args.lr_scheduler == "cosineannealinglr":
+        lrs = args.lr_min + (args.lr - args.lr_min) * (1 + np.cos(np.pi * main_step / main_iters)) / 2
+    elif args.lr_scheduler == "polynomiallr":
+        lrs = args.lr * (1.0 - np.minimum(main_step, main_iters) / main_iters) ** 0.9
+    else:
+        raise RuntimeError(
+            f"Invalid lr scheduler '{args.lr_scheduler}'. Only StepLR, CosineAnnealingLR and PolynomialLR "
+            "are supported."
+        )
+
+    if args.lr_warmup_epochs > 0:
+        if args.lr_warmup_method == "linear":
+            factor = args.lr_warmup_decay + (1.0 - args.lr_warmup_decay) * step / warmup_iters
+        elif args.lr_warmup_method == "constant":
+            factor = np.full_like(step, args.lr_warmup_decay)
+        else:
+            raise RuntimeError(
+                f"Invalid warmup lr method '{args.lr_warmup_method}'. Only linear and constant are supported."
+            )
+        lrs = np.where(step < warmup_iters, args.lr * factor, lrs)
+
+    return lrs.tolist()
+
+
+def evaluate(model, data_loader, scaler, args, epoch=0):
     model.eval()
     metric_logger = utils.MetricLogger(delimiter="  ")
     if args.model == "phasenet_plus":
@@ -42,10 +187,11 @@ def evaluate(model, data_loader, scaler, args, epoch=0, total_samples=1):
         metric_logger.add_meter("loss_polarity", utils.SmoothedValue(window_size=1, fmt="{value}"))
     header = f"Test: "
 
-    processed_samples = 0
+    ## the iterable datasets stream without an epoch end, so stop after len(data_loader) batches, before fetching more
+    max_iters = len(data_loader)
     with torch.inference_mode():
-        for meta in metric_logger.log_every(data_loader, args.print_freq, header):
-            output = model(meta)
+        for i, meta in enumerate(metric_logger.log_every(data_loader, args.print_freq, header)):
+            output = model(model_inputs(meta, args))
             batch_size = meta["data"].shape[0]
 
             metric_logger.meters["loss"].update(output["loss"].item(), n=batch_size)
@@ -55,8 +201,7 @@ def evaluate(model, data_loader, scaler, args, epoch=0, total_samples=1):
                 metric_logger.meters["loss_event_time"].update(output["loss_event_time"].item(), n=batch_size)
                 metric_logger.meters["loss_polarity"].update(output["loss_polarity"].item(), n=batch_size)
 
-            processed_samples += batch_size
-            if processed_samples > total_samples:
+            if i + 1 >= max_iters:
                 break
 
     metric_logger.synchronize_between_processes()
@@ -88,7 +233,8 @@ def train_one_epoch(
     scaler,
     args,
     epoch,
-    total_samples,
+    graphed_model=None,
+    overlapped_optimizer=None,
 ):
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter("lr", utils.SmoothedValue(window_size=1, fmt="{value}"))
@@ -102,17 +248,29 @@ def train_one_epoch(
     ctx = (
         nullcontext()
         if args.device in ["cpu", "mps"]
-        else torch.amp.autocast(device_type=args.device, dtype=args.ptdtype)
+        else torch.amp.autocast(device_type=args.device, dtype=args.ptdtype, cache_enabled=(graphed_model is None))
     )
+    loss_names = ["loss"]
+    if args.model == "phasenet_plus":
+        loss_names += ["loss_phase", "loss_event_center", "loss_event_time", "loss_polarity"]
+    ## losses are summed on the device and read back once per print_freq steps, so the loop does not sync every step
+    loss_sums = None
+    num_steps = 0
+
     model.train()
-    processed_samples = 0
-    for i, meta in enumerate(metric_logger.log_every(data_loader, args.print_freq, header)):
+    max_iters = len(data_loader)
+    if args.device == "cuda":
+        data_loader = utils.CudaPrefetcher(data_loader, args.device)
+    for i, meta in metric_logger.iter_batches(data_loader, args.print_freq, header):
         with ctx:
-            output = model(meta)
+            if graphed_model is not None:
+                output = graphed_model(meta)
+            else:
+                output = model(model_inputs(meta, args))
 
         loss = output["loss"]
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         if scaler is not None:
             scaler.scale(loss).backward()
             if args.clip_grad_norm is not None:
@@ -120,63 +278,90 @@ def train_one_epoch(
                 nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
             scaler.step(optimizer)
             scaler.update()
+        elif overlapped_optimizer is not None:
+            loss.backward()
         else:
             loss.backward()
             if args.clip_grad_norm is not None:
                 nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
             optimizer.step()
         lr_scheduler.step()
+        if overlapped_optimizer is not None:
+            overlapped_optimizer.defaults["lr"] = optimizer.param_groups[0]["lr"]
 
         if model_ema and i % args.model_ema_steps == 0:
             model_ema.update_parameters(model)
             if epoch < args.lr_warmup_epochs:
                 model_ema.n_averaged.fill_(0)
 
-        batch_size = meta["data"].shape[0]
-        processed_samples += batch_size
-        if processed_samples >= total_samples:
+        if i + 1 >= max_iters:
             break
 
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]["lr"])
-        if args.model == "phasenet_plus":
-            metric_logger.update(loss_phase=output["loss_phase"].item())
-            metric_logger.update(loss_event_center=output["loss_event_center"].item())
-            metric_logger.update(loss_event_time=output["loss_event_time"].item())
-            metric_logger.update(loss_polarity=output["loss_polarity"].item())
+        losses = torch.stack([output[name].detach().float() for name in loss_names])
+        loss_sums = losses if loss_sums is None else loss_sums + losses
+        num_steps += 1
+        if i % args.print_freq != 0:
+            continue
+        losses = dict(zip(loss_names, (loss_sums / num_steps).tolist()))
+        loss_sums = None
+        num_steps = 0
+
+        metric_logger.update(**losses, lr=optimizer.param_groups[0]["lr"])
         if args.wandb and utils.is_main_process():
             log = {
-                "train/train_loss": loss.item(),
+                "train/train_loss": losses["loss"],
                 "train/lr": optimizer.param_groups[0]["lr"],
                 "train/epoch": epoch,
                 "train/batch": i,
             }
             if args.model == "phasenet_plus":
-                log["train/loss_phase"] = output["loss_phase"].item()
-                log["train/loss_event_center"] = output["loss_event_center"].item()
-                log["train/loss_event_time"] = output["loss_event_time"].item()
-                log["train/loss_polarity"] = output["loss_polarity"].item()
+                log["train/loss_phase"] = losses["loss_phase"]
+                log["train/loss_event_center"] = losses["loss_event_center"]
+                log["train/loss_event_time"] = losses["loss_event_time"]
+                log["train/loss_polarity"] = losses["loss_polarity"]
             wandb.log(log)
 
     model.eval()
+    if args.device == "cuda":
+        ## the plotting code reads the labels on the host; data stays on the device, where it is normalized
+        meta = {k: (v if k == "data" else utils.to_cpu(v)) for k, v in meta.items()}
+        torch.cuda.synchronize()
     plot_results(meta, model, output, args, epoch, "train")
     del meta, output, loss
 
 
+def normalize_on_device(data, args, **kwargs):
+    ## the moving-window pooling runs on the GPU; only the normalized waveforms are copied back for plotting
+    return moving_normalize(data.to(args.device, non_blocking=True, dtype=torch.float32), **kwargs).cpu()
+
+
+## pinned host copies of the plotted scores, reused across epochs for each prefix
+plot_buffers = {}
+
+
 def plot_results(meta, model, output, args, epoch, prefix=""):
+    buffers = plot_buffers.setdefault(prefix, [])
     with torch.inference_mode():
+        ## probabilities cross to the host as uint8 and are expanded back to float32 there
+        quantize, dequantize = eqnet.utils.quantize_scores, eqnet.utils.dequantize_scores
         if args.model == "phasenet":
-            phase = torch.softmax(output["phase"], dim=1).cpu().float()
-            meta["data"] = moving_normalize(meta["data"])
+            (phase,) = eqnet.utils.to_host(quantize(torch.softmax(output["phase"].float(), dim=1)), buffers=buffers)
+            phase = dequantize(phase)
+            meta["data"] = normalize_on_device(meta["data"], args)
             print("Plotting...")
             eqnet.utils.plot_phasenet_train(meta, phase, epoch=epoch, figure_dir=args.figure_dir, prefix=prefix)
             del phase
 
         elif args.model == "phasenet_plus":
-            phase = torch.softmax(output["phase"], dim=1).cpu().float()
-            event_center = torch.sigmoid(output["event_center"]).cpu().float()
-            event_time = output["event_time"].cpu().float()
-            polarity = torch.sigmoid(output["polarity"]).cpu().float()
-            meta["data"] = moving_normalize(meta["data"])
+            phase, event_center, event_time, polarity = eqnet.utils.to_host(
+                quantize(torch.softmax(output["phase"].float(), dim=1)),
+                quantize(torch.sigmoid(output["event_center"].float())),
+                output["event_time"].float(),
+                quantize(torch.sigmoid(output["polarity"].float())),
+                buffers=buffers,
+            )
+            phase, event_center, polarity = dequantize(phase), dequantize(event_center), dequantize(polarity)
+            meta["data"] = normalize_on_device(meta["data"], args)
             print("Plotting...")
             eqnet.utils.plot_phasenet_plus_train(
                 meta,
@@ -194,21 +379,27 @@ def plot_results(meta, model, output, args, epoch, prefix=""):
             pass
 
         elif args.model == "phasenet_das":
-            phase = torch.softmax(output["phase"], dim=1).cpu().float()
-            meta["data"] = moving_normalize(meta["data"], filter=2048, stride=256)
+            (phase,) = eqnet.utils.to_host(quantize(torch.softmax(output["phase"].float(), dim=1)), buffers=buffers)
+            phase = dequantize(phase)
+            meta["data"] = normalize_on_device(meta["data"], args, filter=2048, stride=256)
             print("Plotting...")
             eqnet.utils.plot_das_train(meta, phase, epoch=epoch, figure_dir=args.figure_dir, prefix=prefix)
             del phase
 
         elif args.model == "autoencoder":
             preds = model(meta)
+            meta["data"] = meta["data"].cpu()
             print("Plotting...")
             eqnet.utils.plot_autoencoder_das_train(meta, preds, epoch=epoch, figure_dir=args.figure_dir)
             del preds
 
         elif args.model == "eqnet":
-            phase = F.softmax(output["phase"], dim=1).cpu().float()
-            event = torch.sigmoid(output["event"]).cpu().float()
+            phase, event = eqnet.utils.to_host(
+                quantize(F.softmax(output["phase"].float(), dim=1)),
+                quantize(torch.sigmoid(output["event"].float())),
+                buffers=buffers,
+            )
+            phase, event = dequantize(phase), dequantize(event)
             print("Plotting...")
             eqnet.utils.plot_eqnet_train(meta, phase, event, epoch=epoch, figure_dir=args.figure_dir)
             del phase, event
@@ -237,7 +428,8 @@ def main(args):
     device = torch.device(args.device)
     dtype = "bfloat16" if (torch.cuda.is_available() and torch.cuda.is_bf16_supported()) else "float16"
     ptdtype = {"float32": torch.float32, "bfloat16": torch.bfloat16, "float16": torch.float16}[dtype]
-    scaler = torch.cuda.amp.GradScaler(enabled=((dtype == "float16") & torch.cuda.is_available()))
+    ## bfloat16 has the float32 exponent range, so loss scaling is only needed for float16
+    scaler = torch.cuda.amp.GradScaler() if (dtype == "float16") and (device.type == "cuda") else None
     args.dtype, args.ptdtype = dtype, ptdtype
     torch.backends.cuda.matmul.allow_tf32 = True  # allow tf32 on matmul
     torch.backends.cudnn.allow_tf32 = True  # allow tf32 on cudnn
@@ -247,8 +439,11 @@ def main(args):
     else:
         torch.backends.cudnn.benchmark = True
 
+    collate_fn = None
     if args.model in ["phasenet", "phasenet_plus"]:
-        dataset = SeismicTraceIterableDataset(
+        ## map-style, so each worker reads and stacks a whole batch per fetch; indices are drawn with replacement
+        ## like the iterable dataset's sampling, from the rank's shard of the traces
+        dataset = SeismicTraceDataset(
             data_path=args.data_path,
             data_list=args.data_list,
             hdf5_file=args.hdf5_file,
@@ -260,9 +455,9 @@ def main(args):
             rank=rank,
             world_size=world_size,
         )
-        train_sampler = None
+        train_sampler = torch.utils.data.RandomSampler(dataset, replacement=True)
         if args.test_hdf5_file is not None:
-            dataset_test = SeismicTraceIterableDataset(
+            dataset_test = SeismicTraceDataset(
                 data_path=args.test_data_path,
                 data_list=args.test_data_list,
                 hdf5_file=args.test_hdf5_file,
@@ -274,9 +469,11 @@ def main(args):
                 rank=rank,
                 world_size=world_size,
             )
+            test_sampler = torch.utils.data.RandomSampler(dataset_test, replacement=True)
         else:
             dataset_test = None
-        test_sampler = None
+            test_sampler = None
+        collate_fn = collate_batch
     elif args.model == "phasenet_das":
         dataset = DASIterableDataset(
             data_path=args.data_path,
@@ -349,8 +546,15 @@ def main(args):
                 train_sampler = torch.utils.data.RandomSampler(dataset)
                 test_sampler = torch.utils.data.SequentialSampler(dataset_test)
 
-            group_ids = create_groups(dataset, args.num_stations_list)
-            dataset = dataset.map(lambda x: cut_reorder_keys(x, num_stations_list=args.num_stations_list))
+            ## grouping only needs the station locations, so do not decode the waveforms of every event for it
+            group_ids = create_groups(dataset.select_columns(["station_location"]), args.num_stations_list)
+            dataset = dataset.map(
+                cut_reorder_keys_batched,
+                batched=True,
+                batch_size=256,
+                num_proc=(args.workers if args.workers > 0 else None),
+                fn_kwargs={"num_stations_list": args.num_stations_list},
+            )
             train_batch_sampler = StationSampler(train_sampler, group_ids, args.batch_size, args.num_stations_list)
 
         else:
@@ -366,6 +570,9 @@ def main(args):
             dataset,
             batch_sampler=train_batch_sampler,
             num_workers=args.workers,
+            pin_memory=(device.type == "cuda"),
+            persistent_workers=(args.workers > 0),
+            prefetch_factor=(args.prefetch_factor if args.workers > 0 else None),
         )
         data_loader_test = torch.utils.data.DataLoader(
             dataset_test,
@@ -374,6 +581,9 @@ def main(args):
             num_workers=args.workers,
             collate_fn=None,
             drop_last=False,
+            pin_memory=(device.type == "cuda"),
+            persistent_workers=(args.workers > 0),
+            prefetch_factor=(args.prefetch_factor if args.workers > 0 else None),
         )
     else:
         data_loader = torch.utils.data.DataLoader(
@@ -382,9 +592,12 @@ def main(args):
             sampler=train_sampler,
             num_workers=args.workers,
             # collate_fn=utils.collate_fn,
-            collate_fn=None,
+            collate_fn=collate_fn,
             # shuffle=True,
             drop_last=True,
+            pin_memory=(device.type == "cuda"),
+            persistent_workers=(args.workers > 0),
+            prefetch_factor=(args.prefetch_factor if args.workers > 0 else None),
         )
 
         data_loader_test = torch.utils.data.DataLoader(
@@ -392,23 +605,31 @@ def main(args):
             batch_size=args.batch_size,
             sampler=test_sampler,
             num_workers=args.workers,
-            collate_fn=None,
+            collate_fn=collate_fn,
             drop_last=False,
+            pin_memory=(device.type == "cuda"),
+            persistent_workers=(args.workers > 0),
+            prefetch_factor=(args.prefetch_factor if args.workers > 0 else None),
         )
 
     model = eqnet.models.__dict__[args.model].build_model(
         backbone=args.backbone,
         in_channels=1,
         out_channels=(len(args.phases) + 1),
+        gradient_checkpointing=args.gradient_checkpointing,
     )
     logger.info("Model:\n{}".format(model))
 
     print("Model:\n{}".format(model))
 
     model.to(device)
+    args.channels_last = device.type == "cuda"
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
     if args.compile:
         print("compiling the model...")
-        model = torch.compile(model)  # requires PyTorch 2.0
+        ## fixed crops let Inductor autotune kernels for one shape; only the HuggingFace path varies the station count
+        model = torch.compile(model, mode=args.compile_mode, dynamic=args.huggingface_dataset)  # requires PyTorch 2.0
 
     if args.distributed and args.sync_bn:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
@@ -423,7 +644,8 @@ def main(args):
             config=args,
         )
         if args.wandb_watch:
-            wandb.watch(model, log="all", log_freq=args.print_freq)
+            ## watch hooks serialize every parameter and gradient histogram, so sample them less often than the losses
+            wandb.watch(model, log="all", log_freq=10 * args.print_freq)
 
     if args.resume_wandb:
         if utils.is_main_process():
@@ -455,64 +677,55 @@ def main(args):
             momentum=args.momentum,
             weight_decay=args.weight_decay,
             nesterov="nesterov" in opt_name,
+            foreach=True,
         )
     elif opt_name == "rmsprop":
         optimizer = torch.optim.RMSprop(
-            parameters, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay, eps=0.0316, alpha=0.9
+            parameters,
+            lr=args.lr,
+            momentum=args.momentum,
+            weight_decay=args.weight_decay,
+            eps=0.0316,
+            alpha=0.9,
+            foreach=True,
         )
     elif opt_name == "adamw":
-        optimizer = torch.optim.AdamW(parameters, lr=args.lr, weight_decay=args.weight_decay)
+        ## the fused kernel updates all parameters in one launch instead of one per tensor
+        optimizer = torch.optim.AdamW(
+            parameters, lr=args.lr, weight_decay=args.weight_decay, fused=(device.type == "cuda")
+        )
     else:
         raise RuntimeError(f"Invalid optimizer {args.opt}. Only SGD, RMSprop and AdamW are supported.")
 
     iters_per_epoch = len(data_loader)
-    args.lr_scheduler = args.lr_scheduler.lower()
-    if args.lr_scheduler == "steplr":
-        main_lr_scheduler = torch.optim.lr_scheduler.StepLR(
-            optimizer, step_size=args.lr_step_size * iters_per_epoch, gamma=args.lr_gamma
-        )
-    elif args.lr_scheduler == "cosineannealinglr":
-        main_lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
-            optimizer, T_max=(args.epochs - args.lr_warmup_epochs) * iters_per_epoch, eta_min=args.lr_min
-        )
-    elif args.lr_scheduler == "polynomiallr":
-        main_lr_scheduler = torch.optim.lr_scheduler.PolynomialLR(
-            optimizer, total_iters=iters_per_epoch * (args.epochs - args.lr_warmup_epochs), power=0.9
-        )
-    else:
-        raise RuntimeError(
-            f"Invalid lr scheduler '{args.lr_scheduler}'. Only StepLR, CosineAnnealingLR and PolynomialLR "
-            "are supported."
-        )
-
-    if args.lr_warmup_epochs > 0:
-        if args.lr_warmup_method == "linear":
-            warmup_lr_scheduler = torch.optim.lr_scheduler.LinearLR(
-                optimizer, start_factor=args.lr_warmup_decay, total_iters=args.lr_warmup_epochs * iters_per_epoch
-            )
-        elif args.lr_warmup_method == "constant":
-            warmup_lr_scheduler = torch.optim.lr_scheduler.ConstantLR(
-                optimizer, factor=args.lr_warmup_decay, total_iters=args.lr_warmup_epochs * iters_per_epoch
-            )
-        else:
-            raise RuntimeError(
-                f"Invalid warmup lr method '{args.lr_warmup_method}'. Only linear and constant are supported."
-            )
-        lr_scheduler = torch.optim.lr_scheduler.SequentialLR(
-            optimizer,
-            schedulers=[warmup_lr_scheduler, main_lr_scheduler],
-            milestones=[args.lr_warmup_epochs * iters_per_epoch],
-        )
-    else:
-        lr_scheduler = main_lr_scheduler
+    lr_scheduler = utils.LRTable(optimizer, lr_schedule(args, iters_per_epoch))
 
     model_without_ddp = model
     if args.distributed:
+        ## gradients live in the all-reduce buckets and the bucket order is fixed after the first iteration;
+        ## with SyncBatchNorm the running stats already agree across ranks, so they need no broadcast
         model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[args.gpu]
+            model,
+            device_ids=[args.gpu],
+            gradient_as_bucket_view=True,
+            static_graph=True,
+            broadcast_buffers=(not args.sync_bn),
         )  # , find_unused_parameters=True)
         model_without_ddp = model.module
 
+    overlapped_optimizer = None
+    if args.overlap_optim:
+        if (
+            args.distributed
+            and isinstance(optimizer, (torch.optim.SGD, torch.optim.AdamW))
+            and (len(optimizer.param_groups) == 1)
+            and (args.clip_grad_norm is None)
+            and (scaler is None)
+        ):
+            overlapped_optimizer = overlap_optimizer(model, optimizer)
+        else:
+            print("--overlap-optim needs DDP, SGD or AdamW with one parameter group and no clipping; running eagerly")
+
     model_ema = None
     if args.model_ema:
         adjust = args.world_size * args.batch_size * args.model_ema_steps / args.epochs
@@ -535,16 +748,28 @@ def main(args):
             if model_ema:
                 model_ema.load_state_dict(checkpoint["model_ema"])
             if args.resume_opt:
-                optimizer.load_state_dict(checkpoint["optimizer"])
+                load_optimizer_state_dict(optimizer, checkpoint["optimizer"], overlapped_optimizer)
                 lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
                 args.start_epoch = checkpoint["epoch"] + 1
-                if scaler:
+                if scaler and ("scaler" in checkpoint):
                     scaler.load_state_dict(checkpoint["scaler"])
 
+    graphed_model = None
+    if args.cuda_graph:
+        static_shapes = not (args.distributed or args.compile or args.huggingface_dataset)
+        if (device.type == "cuda") and static_shapes and (scaler is None):
+            print("capturing CUDA graphs...")
+            model.train()
+            graphed_model = make_graphed_model(model, next(iter(data_loader)), args)
+        else:
+            print("--cuda-graph needs a single GPU, fixed-shape batches, no --compile and no float16; running eagerly")
+
+    save_pool = ThreadPoolExecutor(max_workers=1)
+    save_future = None
     start_time = time.time()
     best_loss = float("inf")
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed and (train_sampler is not None):
+        if isinstance(train_sampler, torch.utils.data.distributed.DistributedSampler):
             train_sampler.set_epoch(epoch)
 
         tmp_time = time.time()
@@ -557,21 +782,22 @@ def main(args):
             scaler,
             args,
             epoch,
-            len(dataset),
+            graphed_model=graphed_model,
+            overlapped_optimizer=overlapped_optimizer,
         )
         print(f"Training time of epoch {epoch} of rank {rank}: {time.time() - tmp_time:.3f}")
 
         if args.test_hdf5_file is not None:
             tmp_time = time.time()
-            metric = evaluate(model, data_loader_test, scaler, args, epoch, len(dataset_test))
+            metric = evaluate(model, data_loader_test, scaler, args, epoch)
             if model_ema:
-                metric = evaluate(model_ema, data_loader_test, scaler, args, epoch, len(dataset_test))
+                metric = evaluate(model_ema, data_loader_test, scaler, args, epoch)
             print(f"Testing time of epoch {epoch} of rank {rank}: {time.time() - tmp_time:.3f}")
 
         tmp_time = time.time()
         checkpoint = {
             "model": model_without_ddp.state_dict(),
-            "optimizer": optimizer.state_dict(),
+            "optimizer": optimizer_state_dict(optimizer, overlapped_optimizer),
             "lr_scheduler": lr_scheduler.state_dict(),
             "epoch": epoch,
             "args": args,
@@ -581,15 +807,28 @@ def main(args):
         if scaler:
             checkpoint["scaler"] = scaler.state_dict()
 
-        utils.save_on_master(checkpoint, os.path.join(args.output_dir, f"model_{epoch}.pth"))
-        utils.save_on_master(checkpoint, os.path.join(args.output_dir, "checkpoint.pth"))
         if utils.is_main_process():
             if args.test_hdf5_file is None:
                 best_loss = None
             elif metric.loss.global_avg < best_loss:
                 best_loss = metric.loss.global_avg
-            torch.save(checkpoint, os.path.join(args.output_dir, "model_best.pth"))
+            ## stage the checkpoint on the host and write it in the background while the next epoch trains
+            checkpoint = utils.to_cpu(checkpoint)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            if save_future is not None:
+                save_future.result()
+            save_future = save_pool.submit(
+                utils.save_checkpoint,
+                checkpoint,
+                [
+                    os.path.join(args.output_dir, f"model_{epoch}.pth"),
+                    os.path.join(args.output_dir, "checkpoint.pth"),
+                    os.path.join(args.output_dir, "model_best.pth"),
+                ],
+            )
             if args.wandb:
+                save_future.result()
                 best_model = wandb.Artifact(
                     f"{args.wandb_name}",
                     type="model",
@@ -598,6 +837,9 @@ def main(args):
                 best_model.add_file(os.path.join(args.output_dir, "model_best.pth"))
                 wandb.log_artifact(best_model)
 
+    if save_future is not None:
+        save_future.result()
+    save_pool.shutdown(wait=True)
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print(f"Training time {total_time_str}")
@@ -606,8 +848,6 @@ def main(args):
 
 
 def get_args_parser(add_help=True):
-    import argparse
-
     parser = argparse.ArgumentParser(description="PyTorch Segmentation Training", add_help=add_help)
 
     parser.add_argument("--data-path", default="./", type=str, help="dataset path")
@@ -636,6 +876,27 @@ def get_args_parser(add_help=True):
         action="store_true",
         help="compile model to torchscript",
     )
+    parser.add_argument(
+        "--gradient-checkpointing",
+        action="store_true",
+        help="recompute the UNet block activations in backward to fit larger batches",
+    )
+    parser.add_argument(
+        "--overlap-optim",
+        action="store_true",
+        help="run the SGD/AdamW step per gradient bucket inside the DDP all-reduce hook",
+    )
+    parser.add_argument(
+        "--cuda-graph",
+        action="store_true",
+        help="replay forward and backward as CUDA graphs (fixed-shape batches, single GPU)",
+    )
+    parser.add_argument(
+        "--compile-mode",
+        default="max-autotune",
+        type=str,
+        help="torch.compile mode: default, reduce-overhead or max-autotune",
+    )
     parser.add_argument(
         "-b",
         "--batch-size",
@@ -650,14 +911,8 @@ def get_args_parser(add_help=True):
         metavar="N",
         help="number of total epochs to run",
     )
-    parser.add_argument(
-        "-j",
-        "--workers",
-        default=4,
-        type=int,
-        metavar="N",
-        help="number of data loading workers (default: 16)",
-    )
+    add_workers_argument(parser)
+    parser.add_argument("--prefetch-factor", default=4, type=int, help="batches loaded in advance by each worker")
 
     ## training hyper params
     parser.add_argument("--opt", default="adamw", type=str, help="optimizer")
@@ -794,7 +1049,9 @@ def get_args_parser(add_help=True):
     parser.add_argument("--wandb-name", default=None, type=str, help="wandb run name")
     parser.add_argument("--wandb-group", default=None, type=str, help="wandb group name")
     parser.add_argument("--wandb-dir", default="./", type=str, help="wandb dir")
-    parser.add_argument("--wandb-watch", action="store_true", help="wandb watch model")
+    parser.add_argument(
+        "--wandb-watch", action="store_true", help="wandb watch model (histograms every 10 x print-freq steps)"
+    )
 
     # huggingface dataset
     parser.add_argument("--huggingface-dataset", action="store_true", help="use huggingface dataset")
@@ -171,6 +171,50 @@ class MetricLogger:
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print(f"{header} Total time: {total_time_str}")
 
+    def iter_batches(self, iterable, print_freq, header=None):
+        """Like log_every, but yields (i, obj) and keeps only running sums between the print_freq steps; the
+        printed time and data are averages over the steps since the previous print.
+        """
+        if not header:
+            header = ""
+        num_batches = len(iterable)
+        space_fmt = ":" + str(len(str(num_batches))) + "d"
+        fields = [header, "[{0" + space_fmt + "}/{1}]", "eta: {eta}", "{meters}"]
+        fields += ["time: {time:.4f}", "data: {data:.4f}"]
+        if torch.cuda.is_available():
+            fields.append("max mem: {memory:.0f}")
+        log_msg = self.delimiter.join(fields + ["{datetime}"])
+        MB = 1024.0 * 1024.0
+        start_time = window_start = end = time.time()
+        data_time = 0.0
+        num_steps = 0
+        for i, obj in enumerate(iterable):
+            data_time += time.time() - end
+            yield i, obj
+            num_steps += 1
+            if i % print_freq == 0:
+                now = time.time()
+                iter_time = (now - window_start) / num_steps
+                print(
+                    log_msg.format(
+                        i,
+                        num_batches,
+                        eta=str(datetime.timedelta(seconds=int(iter_time * (num_batches - i)))),
+                        meters=str(self),
+                        time=iter_time,
+                        data=data_time / num_steps,
+                        memory=torch.cuda.max_memory_allocated() / MB if torch.cuda.is_available() else 0,
+                        datetime=datetime.datetime.now().strftime("%m-%dT%H:%M:%S"),
+                    )
+                )
+                window_start = now
+                data_time = 0.0
+                num_steps = 0
+            end = time.time()
+        total_time = time.time() - start_time
+        total_time_str = str(datetime.timedelta(seconds=int(total_time)))
+        print(f"{header} Total time: {total_time_str}")
+
 
 class ExponentialMovingAverage(torch.optim.swa_utils.AveragedModel):
     """Maintains moving averages of model parameters using an exponential decay.
@@ -186,6 +230,40 @@ class ExponentialMovingAverage(torch.optim.swa_utils.AveragedModel):
         super().__init__(model, device, ema_avg, use_buffers=True)
 
 
+class LRTable:
+    """Steps the learning rate through a precomputed table; a drop-in for the torch schedulers used in train.py.
+
+    The param groups are only written when the rate changes, and the checkpoint state is the step count, which is
+    also read from the "last_epoch" of checkpoints saved with a torch scheduler.
+    """
+
+    def __init__(self, optimizer, lrs):
+        self.optimizer = optimizer
+        self.lrs = lrs
+        self.last_step = 0
+        self._set_lr()
+
+    def _set_lr(self):
+        lr = self.lrs[min(self.last_step, len(self.lrs) - 1)]
+        if lr != self.optimizer.param_groups[0]["lr"]:
+            for group in self.optimizer.param_groups:
+                group["lr"] = lr
+
+    def step(self):
+        self.last_step += 1
+        self._set_lr()
+
+    def get_last_lr(self):
+        return [group["lr"] for group in self.optimizer.param_groups]
+
+    def state_dict(self):
+        return {"last_step": self.last_step}
+
+    def load_state_dict(self, state_dict):
+        self.last_step = state_dict["last_step"] if "last_step" in state_dict else state_dict["last_epoch"]
+        self._set_lr()
+
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.inference_mode():
@@ -253,11 +331,73 @@ def is_main_process():
     return get_rank() == 0
 
 
+def barrier(args):
+    ## with NCCL, pass this rank's device so the barrier does not have to guess it
+    if not is_dist_avail_and_initialized():
+        return
+    dist.barrier(device_ids=[args.gpu])
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
 
 
+class CudaPrefetcher:
+    """Wraps a data loader and copies batch i + 1 to the GPU on a side stream while batch i is being used."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.stream = torch.cuda.Stream(self.device)
+        self._preload()
+        return self
+
+    def _preload(self):
+        self.batch = next(self.iterator, None)
+        if self.batch is None:
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = {
+                k: (v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v) for k, v in self.batch.items()
+            }
+
+    def __next__(self):
+        if self.batch is None:
+            raise StopIteration
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.batch
+        for v in batch.values():
+            if torch.is_tensor(v):
+                v.record_stream(torch.cuda.current_stream(self.device))
+        self._preload()
+        return batch
+
+
+def to_cpu(obj):
+    ## snapshot nested tensors on the host, so a background save is not affected by the next training step
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == "cpu":
+            return obj.detach().clone()
+        return obj.detach().to("cpu", non_blocking=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def save_checkpoint(checkpoint, paths):
+    for path in paths:
+        torch.save(checkpoint, path)
+
+
 def init_distributed_mode(args):
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
         args.rank = int(os.environ["RANK"])
@@ -284,7 +424,7 @@ def init_distributed_mode(args):
         torch.distributed.init_process_group(
             backend=args.dist_backend, init_method=args.dist_url, world_size=args.world_size, rank=args.rank
         )
-        torch.distributed.barrier()
+        barrier(args)
         setup_for_distributed(args.rank == 0)
 
 